@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the crawl, sanitize, JSON write, and render phases of dlhn
+against a local fake Hacker News API (see fakehn.py)
+
+Usage::
+
+    python benchmarks/bench_dlhn.py --stories 200 --depth 3 --fanout 4 \\
+        --save benchmarks/results.jsonl
+
+    # compare with the last saved result (e.g. from an older version)
+    python benchmarks/bench_dlhn.py --compare benchmarks/results.jsonl
+"""
+import argparse
+import collections
+import copy
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from dlhn import dlhn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakehn  # noqa: E402
+
+
+def timed(func, repeat=1):
+    """
+    Returns:
+        tuple: (best of ``repeat`` wall times in seconds, last result)
+    """
+    best = None
+    for n in range(repeat):
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_dlhn(basedir):
+    """Point the dlhn globals at a new, empty cache in basedir"""
+    dlhn.REQUESTS = None
+    dlhn.CLEAN_MEMO = None
+    dlhn.FRAGMENT_MEMO = None
+    dlhn.build_requests_session(basedir, always_set=True, rate=0)
+
+
+def bench_json_formats(data, basedir, repeat=3):
+    """
+    Time write_json and read_json with each installed JSON backend
+    and compression
+
+    Returns:
+        OrderedDict: {'<backend>[.<compression>]': {'bytes': ...,
+            'write_s': ..., 'read_s': ..., 'write_mbps': ...,
+            'read_mbps': ...}} where MB/s are of uncompressed JSON
+    """
+    backends = ['json']
+    compressions = [None, 'gz']
+    try:
+        import orjson  # noqa: F401
+        backends.append('orjson')
+    except ImportError:
+        pass
+    try:
+        import zstandard  # noqa: F401
+        compressions.append('zst')
+    except ImportError:
+        pass
+    formats = collections.OrderedDict()
+    size = None
+    for backend in backends:
+        for compression in compressions:
+            name = backend + ('.%s' % compression if compression else '')
+            path = os.path.join(basedir, 'formats.json')
+            if compression:
+                path += '.' + compression
+            write_s, _ = timed(
+                lambda: dlhn.write_json(data, path, backend=backend),
+                repeat=repeat)
+            read_s, _ = timed(
+                lambda: dlhn.read_json(path, backend=backend),
+                repeat=repeat)
+            if size is None:
+                size = os.path.getsize(path)
+            record = collections.OrderedDict()
+            record['bytes'] = os.path.getsize(path)
+            record['write_s'] = write_s
+            record['read_s'] = read_s
+            record['write_mbps'] = size / float(1 << 20) / write_s
+            record['read_mbps'] = size / float(1 << 20) / read_s
+            formats[name] = record
+            os.remove(path)
+    return formats
+
+
+def run(args):
+    """
+    Run the benchmarks
+
+    Returns:
+        OrderedDict: result record
+    """
+    users, items = fakehn.make_tree(
+        stories=args.stories, depth=args.depth, fanout=args.fanout,
+        own_every=args.own_every)
+    server = fakehn.start_server(users, items, latency=args.latency)
+    dlhn.HN_API_URL = server.api_url
+    basedir = tempfile.mkdtemp(prefix='dlhn-bench-')
+    phases = collections.OrderedDict()
+    counts = collections.OrderedDict()
+    try:
+        crawldir = os.path.join(basedir, 'crawl')
+        os.makedirs(crawldir)
+        reset_dlhn(crawldir)
+        phases['crawl_cold'], (crawled, roots) = timed(
+            lambda: dlhn.get_items(fakehn.USERNAME, jobs=args.jobs))
+        counts['items'] = len(crawled)
+        counts['roots'] = len(roots)
+        counts['requests_cold'] = server.requests
+        phases['crawl_requests_cache'], _ = timed(
+            lambda: dlhn.get_items(fakehn.USERNAME, jobs=args.jobs))
+
+        texts = collections.OrderedDict(
+            (str(key), dict(type='comment', text=item['text']))
+            for key, item in items.items() if 'text' in item)
+        phases['sanitize'], _ = timed(
+            lambda: dlhn.upgrade_items(copy.deepcopy(texts), jobs=args.jobs),
+            repeat=args.repeat)
+
+        data = collections.OrderedDict()
+        data['usernames'] = [fakehn.USERNAME]
+        data['items'] = crawled
+        data['roots'] = roots
+        data = dlhn.normalize_data(data)
+        jsonpath = os.path.join(basedir, 'index.html.json')
+        phases['json_write'], _ = timed(
+            lambda: dlhn.write_json(data, jsonpath), repeat=args.repeat)
+        counts['json_bytes'] = os.path.getsize(jsonpath)
+
+        phases['json_read'], _ = timed(
+            lambda: dlhn.read_json(jsonpath), repeat=args.repeat)
+        formats = bench_json_formats(data, basedir, repeat=args.repeat)
+
+        htmlpath = os.path.join(basedir, 'index.html')
+        phases['render'], _ = timed(
+            lambda: dlhn.render_html(data, htmlpath), repeat=args.repeat)
+        counts['html_bytes'] = os.path.getsize(htmlpath)
+
+        dlhn.build_fragment_memo(basedir, always_set=True)
+        phases['render_fragments_cold'], _ = timed(
+            lambda: dlhn.render_html(data, htmlpath))
+        dlhn.FRAGMENT_MEMO.flush()
+        phases['render_fragments_warm'], _ = timed(
+            lambda: dlhn.render_html(data, htmlpath), repeat=args.repeat)
+        changed = data['items'][str(data['roots'][0])]
+        changed['score'] = (changed.get('score') or 0) + 1
+        phases['render_fragments_one_changed'], _ = timed(
+            lambda: dlhn.render_html(data, htmlpath))
+        dlhn.FRAGMENT_MEMO = None
+
+        e2edir = os.path.join(basedir, 'e2e')
+        os.makedirs(e2edir)
+        reset_dlhn(e2edir)
+        output = os.path.join(e2edir, 'index.html')
+        phases['dlhn_cold'], (_, metrics) = timed(lambda: dlhn.dlhn(
+            fakehn.USERNAME, output=output, jobs=args.jobs,
+            return_html=False, return_metrics=True))
+        phases['dlhn_warm'], _ = timed(lambda: dlhn.dlhn(
+            fakehn.USERNAME, output=output, jobs=args.jobs,
+            return_html=False))
+    finally:
+        server.shutdown()
+        shutil.rmtree(basedir)
+
+    result = collections.OrderedDict()
+    result['version'] = dlhn.__version__
+    result['revision'] = get_revision()
+    result['python'] = platform.python_version()
+    result['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    result['params'] = collections.OrderedDict(
+        (key, getattr(args, key)) for key in
+        ('stories', 'depth', 'fanout', 'own_every', 'jobs', 'latency',
+         'repeat'))
+    result['counts'] = counts
+    result['phases'] = phases
+    result['json_formats'] = formats
+    result['dlhn_cold_metrics'] = metrics
+    return result
+
+
+def print_result(result, baseline=None):
+    print('dlhn %s (%s), python %s, %s' % (
+        result['version'], result['revision'], result['python'],
+        json.dumps(result['params'])))
+    print('%s' % json.dumps(result['counts']))
+    for phase, seconds in result['phases'].items():
+        line = '%-22s %9.3fs' % (phase, seconds)
+        if baseline is not None and phase in baseline['phases']:
+            before = baseline['phases'][phase]
+            line += '  %9.3fs before  (%.2fx)' % (
+                before, before / seconds if seconds else float('inf'))
+        print(line)
+    for name, record in result.get('json_formats', {}).items():
+        line = ('%-22s %9d bytes  write %7.1f MB/s  read %7.1f MB/s'
+                % (name, record['bytes'], record['write_mbps'],
+                   record['read_mbps']))
+        before = (baseline or {}).get('json_formats', {}).get(name)
+        if before is not None:
+            line += '  (%.2fx, %.2fx)' % (
+                before['write_s'] / record['write_s'],
+                before['read_s'] / record['read_s'])
+        print(line)
+
+
+def main():
+    prs = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    prs.add_argument('--stories', type=int, default=50)
+    prs.add_argument('--depth', type=int, default=3)
+    prs.add_argument('--fanout', type=int, default=4)
+    prs.add_argument('--own-every', type=int, default=5)
+    prs.add_argument('-j', '--jobs', type=int, default=1)
+    prs.add_argument('--latency', type=float, default=0,
+                     help='seconds the fake API waits before each response')
+    prs.add_argument('--repeat', type=int, default=3,
+                     help='repetitions of the offline phases (best of)')
+    prs.add_argument('--save', metavar='RESULTS_JSONL',
+                     help='append the result to this file')
+    prs.add_argument('--compare', metavar='RESULTS_JSONL',
+                     help='compare with the last result in this file')
+    prs.add_argument('-v', '--verbose', action='store_true')
+    args = prs.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as _file:
+            lines = [line for line in _file if line.strip()]
+        baseline = json.loads(lines[-1]) if lines else None
+
+    result = run(args)
+    print_result(result, baseline=baseline)
+    if args.save:
+        with open(args.save, 'a') as _file:
+            _file.write(json.dumps(result) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark expiring requests_cache entries by creation time:
+the full-scan ``remove_new_entries`` vs. the indexed ``CreatedIndex.remove``
+
+Usage::
+
+    python benchmarks/bench_expiry.py --entries 500000
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import requests_cache
+
+from dlhn import dlhn
+
+
+def build_cache(basedir, entries):
+    """
+    Write a synthetic dlhn.sqlite with ``entries`` responses, half created
+    30 days ago and half created 1 day ago
+    """
+    session = requests_cache.CachedSession(
+        cache_name=os.path.join(basedir, 'dlhn'))
+    cache = session.cache
+    now = datetime.datetime.utcnow()
+    blobs = []
+    for days in (30, 1):
+        response = requests_cache.CachedResponse(
+            status_code=200, url='https://hacker-news.firebaseio.com/v0/')
+        response._content = b'{"id": 1}'
+        response.created_at = now - datetime.timedelta(days=days)
+        blobs.append((cache.responses.serialize(response),
+                      dlhn._timestamp(response.created_at)))
+    path = os.path.join(basedir, 'dlhn.sqlite')
+    session.close()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO responses (key, value) VALUES (?, ?)',
+            (('key%d' % n, blobs[n % 2][0]) for n in range(entries)))
+    conn.close()
+    return path
+
+
+def time_it(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    prs = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    prs.add_argument('--entries', type=int, default=500000)
+    args = prs.parse_args()
+
+    basedir = tempfile.mkdtemp(prefix='dlhn-bench-expiry-')
+    try:
+        path = build_cache(basedir, args.entries)
+        backup = path + '.orig'
+        shutil.copy(path, backup)
+        created_after = (datetime.datetime.utcnow()
+                         - datetime.timedelta(days=14))
+
+        session = requests_cache.CachedSession(
+            cache_name=os.path.join(basedir, 'dlhn'))
+        seconds, _ = time_it(lambda: dlhn.remove_new_entries(
+            session.cache, created_after))
+        print('remove_new_entries (full scan): %8.3fs, %d entries left'
+              % (seconds, len(session.cache.responses)))
+        session.close()
+
+        shutil.copy(backup, path)
+        session = requests_cache.CachedSession(
+            cache_name=os.path.join(basedir, 'dlhn'))
+        seconds, index = time_it(
+            lambda: dlhn.CreatedIndex(path, cache=session.cache))
+        print('CreatedIndex backfill (once):  %8.3fs' % seconds)
+        seconds, deleted = time_it(
+            lambda: index.remove(created_after=created_after))
+        print('CreatedIndex.remove (indexed): %8.3fs, %d entries left'
+              % (seconds, len(session.cache.responses)))
+        session.close()
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the memory used by the items of a synthetic archive (see fakehn.py)
+through get_items, normalize_data, write_json, and render_html
+
+Responses are served in-process (as JSON bytes, without HTTP or
+requests_cache) so that only dlhn's own allocations are measured
+(with tracemalloc).
+
+Usage::
+
+    python benchmarks/bench_memory.py --stories 200 --depth 3 --fanout 4
+"""
+import argparse
+import collections
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dlhn import dlhn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakehn  # noqa: E402
+
+
+class BytesResponse(object):
+
+    status_code = 200
+    from_cache = False
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class BytesSession(object):
+    """A stand-in for dlhn.REQUESTS which serves JSON bytes from a dict"""
+
+    def __init__(self, users, items):
+        self.responses = dict(
+            ('user/%s' % key, json.dumps(value).encode('utf8'))
+            for key, value in users.items())
+        self.responses.update(
+            ('item/%d' % key, json.dumps(value).encode('utf8'))
+            for key, value in items.items())
+
+    def get(self, url, **kwargs):
+        path = url.split('/v0/', 1)[1].split('?', 1)[0][:-len('.json')]
+        return BytesResponse(self.responses.get(path, b'null'))
+
+
+def megabytes(size):
+    return size / float(1 << 20)
+
+
+def run(args):
+    """
+    Returns:
+        OrderedDict: result record
+    """
+    users, items = fakehn.make_tree(
+        stories=args.stories, depth=args.depth, fanout=args.fanout,
+        own_every=args.own_every)
+    dlhn.REQUESTS = BytesSession(users, items)
+    dlhn.CLEAN_MEMO = None
+    dlhn.FRAGMENT_MEMO = None
+    del users, items
+    # build these first so that their allocations aren't counted
+    dlhn.build_cleaner()
+    dlhn.get_template()
+    gc.collect()
+    basedir = tempfile.mkdtemp(prefix='dlhn-bench-')
+    result = collections.OrderedDict()
+    try:
+        tracemalloc.start()
+        start = time.time()
+        crawled, roots = dlhn.get_items(fakehn.USERNAME)
+        result['crawl_seconds'] = time.time() - start
+        result['crawl_peak_mb'] = megabytes(
+            tracemalloc.get_traced_memory()[1])
+        gc.collect()
+        result['items'] = len(crawled)
+        result['retained_mb'] = megabytes(tracemalloc.get_traced_memory()[0])
+
+        data = collections.OrderedDict()
+        data['usernames'] = [fakehn.USERNAME]
+        data['items'] = crawled
+        data['roots'] = roots
+        data = dlhn.normalize_data(data)
+        del crawled
+        gc.collect()
+        result['normalized_mb'] = megabytes(
+            tracemalloc.get_traced_memory()[0])
+
+        tracemalloc.reset_peak()
+        dlhn.write_json(data, os.path.join(basedir, 'index.html.json'))
+        result['json_write_peak_mb'] = megabytes(
+            tracemalloc.get_traced_memory()[1])
+
+        tracemalloc.reset_peak()
+        dlhn.render_html(data, os.path.join(basedir, 'index.html'))
+        result['render_peak_mb'] = megabytes(
+            tracemalloc.get_traced_memory()[1])
+        result['bytes_per_item'] = int(
+            (1 << 20) * result['normalized_mb'] / result['items'])
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(basedir)
+    return result
+
+
+def main():
+    prs = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    prs.add_argument('--stories', type=int, default=200)
+    prs.add_argument('--depth', type=int, default=3)
+    prs.add_argument('--fanout', type=int, default=4)
+    prs.add_argument('--own-every', type=int, default=5)
+    args = prs.parse_args()
+
+    result = run(args)
+    print('dlhn %s, %s' % (dlhn.__version__, json.dumps(vars(args))))
+    for key, value in result.items():
+        print('%-20s %12.2f' % (key, value))
+
+
+if __name__ == "__main__":
+    main()
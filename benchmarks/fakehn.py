@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+fakehn -- a local stand-in for the Firebase Hacker News API
+which serves a synthetic tree of users and items
+
+Usage::
+
+    python benchmarks/fakehn.py --stories 100 --depth 3 --fanout 4
+
+    # then point dlhn at it
+    python -c "from dlhn import dlhn; \\
+        dlhn.HN_API_URL = 'http://127.0.0.1:8765/v0'; \\
+        dlhn.main(['-u', 'benchuser', '-o', '/tmp/bench/index.html'])"
+"""
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+log = logging.getLogger('fakehn')
+
+USERNAME = 'benchuser'
+
+TEXT = (
+    'Comment {id} by {by} with <i>markup</i> &amp; entities, a link'
+    ' https://example.com/{id} and <p>a second paragraph'
+    ' with &quot;quotes&quot; and <code>code</code>')
+
+
+def make_tree(stories=100, depth=3, fanout=4, own_every=5,
+              username=USERNAME, start_time=1500000000):
+    """
+    Make a synthetic HN tree: ``stories`` stories by other users,
+    each with comment trees ``depth`` levels deep and ``fanout`` kids per
+    item, where every ``own_every``-th comment is by ``username``
+
+    Returns:
+        tuple: (users, items) dicts as served by the API
+    """
+    items = {}
+    submitted = []
+    ids = iter(range(1, 1 << 62))
+    counter = [0]
+
+    def add_kids(parent, level):
+        if level > depth:
+            return
+        for n in range(fanout):
+            itemid = next(ids)
+            counter[0] += 1
+            by = username if counter[0] % own_every == 0 else 'user%d' % (
+                counter[0] % 97)
+            item = dict(by=by, id=itemid, parent=parent['id'],
+                        time=start_time + itemid, type='comment')
+            item['text'] = TEXT.format(id=itemid, by=by)
+            items[itemid] = item
+            parent.setdefault('kids', []).append(itemid)
+            if by == username:
+                submitted.append(itemid)
+            add_kids(item, level + 1)
+
+    for n in range(stories):
+        itemid = next(ids)
+        story = dict(by='user%d' % (n % 97), id=itemid, score=n,
+                     time=start_time + itemid, title='Story %d' % itemid,
+                     type='story', url='https://example.com/story/%d'
+                     % itemid, descendants=0)
+        items[itemid] = story
+        add_kids(story, 1)
+
+    submitted.sort(reverse=True)
+    users = {username: dict(id=username, created=start_time, karma=1,
+                            submitted=submitted)}
+    return users, items
+
+
+class FakeHNHandler(BaseHTTPRequestHandler):
+    """Serves ``/v0/user/<id>.json`` and ``/v0/item/<id>.json``"""
+
+    url_pattern = re.compile(r'^/v0/(user|item)/([^/?]+)\.json')
+
+    def do_GET(self):
+        match = self.url_pattern.match(self.path)
+        body = 'null'
+        if match:
+            kind, key = match.groups()
+            if kind == 'user':
+                obj = self.server.users.get(key)
+            else:
+                obj = self.server.items.get(int(key))
+            body = json.dumps(obj)
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = body.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class FakeHNServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, users, items, address=('127.0.0.1', 0), latency=0):
+        HTTPServer.__init__(self, address, FakeHNHandler)
+        self.users = users
+        self.items = items
+        self.requests = 0
+        self.latency = latency
+
+    @property
+    def api_url(self):
+        return 'http://%s:%d/v0' % self.server_address[:2]
+
+
+def start_server(users, items, address=('127.0.0.1', 0), latency=0):
+    """
+    Start a FakeHNServer in a daemon thread
+
+    Kwargs:
+        latency (float): seconds to wait before each response
+            (to simulate round trips to the API)
+
+    Returns:
+        FakeHNServer: server (call ``.shutdown()`` to stop it)
+    """
+    server = FakeHNServer(users, items, address=address, latency=latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    prs = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    prs.add_argument('--host', default='127.0.0.1')
+    prs.add_argument('--port', type=int, default=8765)
+    prs.add_argument('--stories', type=int, default=100)
+    prs.add_argument('--depth', type=int, default=3)
+    prs.add_argument('--fanout', type=int, default=4)
+    prs.add_argument('--own-every', type=int, default=5)
+    prs.add_argument('--latency', type=float, default=0,
+                     help='seconds to wait before each response')
+    args = prs.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    users, items = make_tree(stories=args.stories, depth=args.depth,
+                             fanout=args.fanout, own_every=args.own_every)
+    server = FakeHNServer(users, items, address=(args.host, args.port),
+                          latency=args.latency)
+    log.info('Serving %d items for %r at %s',
+             len(items), list(users), server.api_url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
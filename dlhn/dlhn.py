@@ -11,16 +11,28 @@ TODO:
 - TODO: expand all / collapse all
 - TODO: favorites
 """
+import array
 import codecs
 import collections
+import contextlib
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
+import operator
 import os
+import shutil
+import sqlite3
 import sys
+import threading
 import time
 
-from functools import partial
+from collections.abc import Mapping, MutableMapping
+from functools import lru_cache, partial
 
 if sys.version_info.major < 3:
     from HTMLParser import HTMLParser
@@ -32,11 +44,9 @@ else:
 
 __version__ = __import__('dlhn').__version__
 
-import bleach
-import bs4
-# pip install --user certifi
-import jinja2
-import requests_cache
+# bleach, bs4, jinja2, and requests_cache are imported on first use
+# (see build_cleaner, get_template_environment, and build_requests_session)
+# so that e.g. ``dlhn --help`` starts quickly
 
 log = logging.getLogger()
 
@@ -44,17 +54,214 @@ chardetlog = logging.getLogger('chardet.charsetprober')
 chardetlog.setLevel(logging.ERROR)
 
 
-def make_throttle_hook(timeout=1.0):
+class Metrics(object):
     """
-    Returns a response hook function which sleeps for `timeout` seconds if
-    response is not cached
+    Wall time per phase and counters for a run (see :func:`dlhn`
+    ``return_metrics`` and ``--metrics``)
+
+    Phases may overlap (e.g. 'sanitize' runs during 'crawl'),
+    and the time of a phase that runs in several threads is the sum
+    of the time spent in each thread.
     """
-    def hook(response, *args, **kwargs):
-        if not getattr(response, 'from_cache', False):
-            log.debug('sleeping')
-            time.sleep(timeout)
+
+    def __init__(self, clock=time.time):
+        """
+        Kwargs:
+            clock (callable): returns the current time in seconds
+        """
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the wall time of the block to phase ``name``"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, self.clock() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        """Set counter ``name`` to value if it's larger"""
+        with self.lock:
+            self.counters[name] = max(self.counters.get(name, 0), value)
+
+    def to_dict(self):
+        """
+        Returns:
+            OrderedDict: {'version': __version__, 'phases': {name: seconds},
+                'counters': {name: value}}
+        """
+        with self.lock:
+            metrics = collections.OrderedDict()
+            metrics['version'] = __version__
+            metrics['phases'] = collections.OrderedDict(
+                (name, round(seconds, 6))
+                for name, seconds in self.phases.items())
+            metrics['counters'] = collections.OrderedDict(
+                (name, round(value, 6) if isinstance(value, float) else value)
+                for name, value in self.counters.items())
+        return metrics
+
+    def write(self, path):
+        """Write :meth:`to_dict` to path as indented JSON"""
+        with open_atomic(path) as _file:
+            json.dump(self.to_dict(), _file, indent=2)
+
+
+METRICS = Metrics()
+
+
+class RateLimiter(object):
+    """
+    A token bucket rate limiter which is shared by all threads
+
+    Each non-cached request takes a token; tokens refill at ``rate``
+    per second up to ``burst``, so callers only wait when the bucket
+    is empty. :meth:`backoff` halves the rate (and honors Retry-After)
+    when the API returns 429 or 5xx; :meth:`recover` raises it back
+    toward the configured rate after successful responses.
+    """
+
+    def __init__(self, rate=2.0, burst=8, min_rate=0.1,
+                 clock=time.time, sleep=time.sleep):
+        """
+        Kwargs:
+            rate (float): requests per second (<= 0 for no limit)
+            burst (int): number of requests allowed without waiting
+            min_rate (float): don't back off to below this rate
+            clock (callable): returns the current time in seconds
+            sleep (callable): sleeps for a number of seconds
+        """
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available
+
+        Returns:
+            float: seconds slept
+        """
+        if self.max_rate <= 0:
+            return 0.0
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve a token; concurrent callers queue up behind it
+            self.tokens -= 1
+            wait = max(
+                -self.tokens / self.rate,
+                self.blocked_until - now,
+                0.0)
+        if wait > 0:
+            log.debug(('throttling', wait))
+            self.sleep(wait)
+            with self.lock:
+                self.throttled += wait
+        return wait
+
+    def backoff(self, retry_after=None):
+        """
+        Halve the rate and block all callers for ``retry_after``
+        (or one token interval at the new rate)
+        """
+        if self.max_rate <= 0:
+            return
+        with self.lock:
+            self.rate = max(self.rate / 2.0, self.min_rate)
+            delay = retry_after if retry_after else 1.0 / self.rate
+            self.blocked_until = max(
+                self.blocked_until, self.clock() + delay)
+            log.warning('Backing off to %.2f requests/s for %.2fs',
+                        self.rate, delay)
+
+    def recover(self):
+        """Increase the rate by 10% of the configured rate"""
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(
+                    self.rate + self.max_rate / 10.0, self.max_rate)
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RateLimitAdapter(object):
+    """
+    A transport adapter (see ``requests.Session.mount``) which takes a
+    token from a :class:`RateLimiter` before each request is sent and
+    backs off if the response status code is in RETRY_STATUS_CODES
+
+    requests_cache only calls the transport adapter for requests which
+    aren't served from the cache, so cached responses don't take tokens.
+    """
+
+    def __init__(self, ratelimiter, adapter=None):
+        """
+        Args:
+            ratelimiter (RateLimiter): the session's rate limiter
+
+        Kwargs:
+            adapter (requests.adapters.BaseAdapter): adapter to send
+                requests with (default: ``requests.adapters.HTTPAdapter()``)
+        """
+        if adapter is None:
+            import requests.adapters
+            adapter = requests.adapters.HTTPAdapter()
+        self.ratelimiter = ratelimiter
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        METRICS.incr('throttled_seconds', self.ratelimiter.acquire())
+        response = self.adapter.send(request, **kwargs)
+        if response.status_code in RETRY_STATUS_CODES:
+            retry_after = response.headers.get('Retry-After')
+            try:
+                retry_after = float(retry_after)
+            except (TypeError, ValueError):
+                retry_after = None
+            self.ratelimiter.backoff(retry_after)
+        else:
+            self.ratelimiter.recover()
         return response
-    return hook
+
+    def close(self):
+        self.adapter.close()
+
+
+def _created_at(response):
+    """
+    Returns:
+        datetime.datetime: response.created_at as a naive UTC datetime
+            (newer requests_cache versions store aware datetimes)
+    """
+    created_at = response.created_at
+    if created_at.tzinfo is not None:
+        created_at = created_at.replace(tzinfo=None) - created_at.utcoffset()
+    return created_at
 
 
 def remove_new_entries(self, created_after):
@@ -63,20 +270,264 @@ def remove_new_entries(self, created_after):
     keys_to_delete = set()
     for key in self.responses:
         response = self.responses.get(key)
-        if response and response.created_at > created_after:
+        if response and _created_at(response) > created_after:
             keys_to_delete.add(key)
 
     for key in keys_to_delete:
         self.delete(key)
 
 
+class FrozenItems(object):
+    """
+    The ids and requests_cache keys of items that can no longer change
+
+    HN items can't be edited after 14 days, so once a fetched item is
+    older than that, :meth:`freeze` records its cache key in the
+    ``dlhn_frozen`` table of the requests_cache database and makes the
+    cached response never expire. Frozen keys are excluded from
+    ``--expire-after`` and ``--expire-newerthan``.
+    """
+
+    def __init__(self, path, cache=None):
+        """
+        Args:
+            path (str): path to the requests_cache sqlite database
+
+        Kwargs:
+            cache (requests_cache.backends.BaseCache): the session's cache
+        """
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS dlhn_frozen'
+                ' (key TEXT PRIMARY KEY, itemid INTEGER, time INTEGER)')
+        self.keys = set(row[0] for row in self.conn.execute(
+            'SELECT key FROM dlhn_frozen'))
+
+    def freeze(self, itemid, response, itemtime=None):
+        """
+        Mark the cached response for an item as immutable
+
+        Args:
+            itemid (int): HN item id
+            response (requests.Response): the item's (cached) response
+
+        Kwargs:
+            itemtime (int): the item's ``time``
+        """
+        key = getattr(response, 'cache_key', None)
+        if key is None and self.cache is not None:
+            key = self.cache.create_key(response.request)
+        if key is None or key in self.keys:
+            return
+        with self.lock:
+            if self.cache is not None:
+                cached = self.cache.responses.get(key)
+                if cached is not None and cached.expires is not None:
+                    cached.expires = None
+                    self.cache.responses[key] = cached
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO dlhn_frozen (key, itemid, time)'
+                    ' VALUES (?, ?, ?)', (key, itemid, itemtime))
+            self.keys.add(key)
+
+
+class CreatedIndex(object):
+    """
+    An index of requests_cache entries by creation time
+
+    requests_cache stores ``created_at`` inside each serialized response,
+    so expiring by creation time means reading every response.
+    CreatedIndex keeps (key, created_at) in an indexed ``dlhn_created``
+    table in the same sqlite database (backfilled from the responses
+    if it's empty) and updated by the response hook from
+    :func:`make_created_hook`, so that :meth:`remove` can expire entries
+    with one indexed range DELETE per direction in a single transaction.
+    Added entries are buffered until :meth:`flush` (or until there are
+    ``flush_every`` of them) so that fetch threads don't contend with
+    requests_cache for the database write lock on every response.
+    :meth:`remove` first indexes any responses which were cached but never
+    flushed (e.g. by a crawl which was killed).
+    """
+
+    def __init__(self, path, cache=None, flush_every=1000):
+        """
+        Args:
+            path (str): path to the requests_cache sqlite database
+
+        Kwargs:
+            cache (requests_cache.backends.BaseCache): the session's cache
+                (to backfill from)
+            flush_every (int): number of added entries to buffer
+        """
+        self.path = path
+        self.cache = cache
+        self.flush_every = flush_every
+        self.pending = {}
+        self.table_name = getattr(
+            getattr(cache, 'responses', None), 'table_name', 'responses')
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS dlhn_created'
+                ' (key TEXT PRIMARY KEY, created_at REAL)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS dlhn_created_at'
+                ' ON dlhn_created (created_at)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS dlhn_frozen'
+                ' (key TEXT PRIMARY KEY, itemid INTEGER, time INTEGER)')
+        count = self.conn.execute(
+            'SELECT COUNT(*) FROM dlhn_created').fetchone()[0]
+        if not count and cache is not None:
+            self.backfill()
+
+    def backfill(self):
+        """
+        Index the creation time of the cached responses
+        which aren't indexed yet
+
+        Returns:
+            int: number of entries indexed
+        """
+        if self.cache is None:
+            return 0
+        with self.lock:
+            keys = [row[0] for row in self.conn.execute(
+                'SELECT key FROM {0} WHERE key NOT IN'
+                ' (SELECT key FROM dlhn_created)'.format(self.table_name))
+                if row[0] not in self.pending]
+        rows = []
+        for key in keys:
+            response = self.cache.responses.get(key)
+            if response is not None:
+                rows.append((key, _timestamp(_created_at(response))))
+        if not rows:
+            return 0
+        log.info('Indexing %d cache entries by creation time', len(rows))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO dlhn_created (key, created_at)'
+                ' VALUES (?, ?)', rows)
+        return len(rows)
+
+    def add(self, key, created_at=None):
+        """
+        Args:
+            key (str): requests_cache key
+
+        Kwargs:
+            created_at (float): UTC timestamp (default: now)
+        """
+        if created_at is None:
+            created_at = time.time()
+        with self.lock:
+            self.pending[key] = created_at
+            if len(self.pending) < self.flush_every:
+                return
+        self.flush()
+
+    def flush(self):
+        """Write buffered entries"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO dlhn_created (key, created_at)'
+                ' VALUES (?, ?)', list(self.pending.items()))
+            self.pending.clear()
+
+    def remove(self, created_after=None, created_before=None):
+        """
+        Delete cache entries created after ``created_after`` or before
+        ``created_before`` (except for frozen entries; see
+        :class:`FrozenItems`) in one transaction
+
+        Kwargs:
+            created_after (datetime.datetime): naive UTC datetime
+            created_before (datetime.datetime): naive UTC datetime
+
+        Returns:
+            int: number of entries deleted
+        """
+        conditions = []
+        if created_after is not None:
+            conditions.append(
+                ('created_at > ?', _timestamp(created_after)))
+        if created_before is not None:
+            conditions.append(
+                ('created_at < ?', _timestamp(created_before)))
+        self.flush()
+        self.backfill()
+        deleted = 0
+        with self.lock, self.conn:
+            for condition, timestamp in conditions:
+                selected = (
+                    'SELECT key FROM dlhn_created WHERE {0}'
+                    ' AND key NOT IN (SELECT key FROM dlhn_frozen)'
+                    .format(condition))
+                deleted += self.conn.execute(
+                    'DELETE FROM {0} WHERE key IN ({1})'
+                    .format(self.table_name, selected),
+                    (timestamp,)).rowcount
+                self.conn.execute(
+                    'DELETE FROM dlhn_created WHERE key IN ({0})'
+                    .format(selected), (timestamp,))
+        return deleted
+
+
+def _timestamp(utcdatetime):
+    """
+    Returns:
+        float: POSIX timestamp of a naive UTC datetime
+    """
+    return (utcdatetime - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+@contextlib.contextmanager
+def flushing(obj):
+    """
+    Flush obj (e.g. a :class:`CreatedIndex`) when the block exits,
+    even if it raises (e.g. KeyboardInterrupt)
+
+    Args:
+        obj: an object with a ``flush`` method, or None
+    """
+    try:
+        yield obj
+    finally:
+        if obj is not None:
+            obj.flush()
+
+
+def make_created_hook(created_index):
+    """
+    Returns a response hook function which adds responses that were
+    just written to the cache to ``created_index``
+    """
+    def hook(response, *args, **kwargs):
+        if not getattr(response, 'from_cache', False):
+            key = getattr(response, 'cache_key', None)
+            if key is not None:
+                created_index.add(key)
+        return response
+    return hook
+
+
 REQUESTS = None
 
+HN_API_URL = 'https://hacker-news.firebaseio.com/v0'
+
 
 def build_requests_session(basedir,
                            expire_after=None,
                            expire_newerthan=None,
-                           always_set=False):
+                           always_set=False,
+                           rate=2.0,
+                           burst=8):
     """
     Build a requests session
 
@@ -89,35 +540,71 @@ def build_requests_session(basedir,
             this
         always_set (bool): if True, always set the REQUESTS global;
             otherwise don't modify the REQUESTS global
+        rate (float): maximum non-cached requests per second
+            (<= 0 for no limit)
+        burst (int): number of requests allowed before throttling
     """
     global REQUESTS
     if REQUESTS is None or always_set:
+        # pip install --user certifi
+        import requests_cache
         # requests_cache.install_cache('dlhn', expire_after=expire_after)
         REQUESTS = requests_cache.CachedSession(
             cache_name=os.path.join(basedir, 'dlhn'),
             expire_after=expire_after)
-        REQUESTS.hooks = {'response': make_throttle_hook(0.5)}
+        REQUESTS.ratelimiter = RateLimiter(rate=rate, burst=burst)
+        cache_path = os.path.join(basedir, 'dlhn.sqlite')
+        REQUESTS.frozen = FrozenItems(cache_path, cache=REQUESTS.cache)
+        REQUESTS.created = CreatedIndex(cache_path, cache=REQUESTS.cache)
+        REQUESTS.hooks = {
+            'response': [make_created_hook(REQUESTS.created)]}
+        for prefix in ('https://', 'http://'):
+            REQUESTS.mount(prefix, RateLimitAdapter(REQUESTS.ratelimiter))
+        now = datetime.datetime.utcnow()
+        created_before = created_after = None
         if expire_after is not None:
             log.info("Removing cache entries older than %r",
                      expire_after)
-            REQUESTS.cache.remove_old_entries(
-                datetime.datetime.utcnow() - expire_after)
+            created_before = now - expire_after
         if expire_newerthan is not None:
             log.info("Removing cache entries newer than %r",
                      expire_newerthan)
-            remove_new_entries(REQUESTS.cache,
-                datetime.datetime.utcnow() - expire_newerthan)
+            created_after = now - expire_newerthan
+        if created_before is not None or created_after is not None:
+            deleted = REQUESTS.created.remove(
+                created_after=created_after,
+                created_before=created_before)
+            log.info("Removed %d cache entries", deleted)
     else:
         log.error('The REQUESTS global is already set.')
 
 
 def dlhn(username, output='index.html',
         inputjson=None,
-        inputjson_upgrade=True):
+        inputjson_upgrade=True,
+        jobs=1,
+        incremental=False,
+        return_html=True,
+        template=None,
+        shard_size=None,
+        store_type='json',
+        export_json=False,
+        per_user=False,
+        fetched=None,
+        metrics=None,
+        return_metrics=False,
+        json_compression=None,
+        lazy=False,
+        resume=False,
+        max_depth=None,
+        max_kids=None,
+        max_items=None,
+        max_seconds=None):
     """pull hacker news comments
 
     Arguments:
         username (str): hackernews username
+            (or a list of usernames to archive together)
 
     Keyword Arguments:
         output (str): path to write output to
@@ -125,182 +612,2451 @@ def dlhn(username, output='index.html',
             from instead of remote fetching (e.g. index.html.json)
         inputjson_upgrade (bool): True to modify the input JSON data
             before writing the template and json (default: True)
+        jobs (int): number of threads to fetch items with (default: 1)
+        incremental (bool): True to only fetch new submissions and
+            items newer than 14 days and merge them into the
+            existing JSON, with the roots in the same order as
+            a full crawl (default: False)
+        return_html (bool): True to render the HTML as a string and
+            return it; False to stream the HTML to output and return None
+            so that memory use doesn't grow with the size of the HTML
+            (default: True)
+        template (str): path to a Jinja2 template to use instead of
+            the built-in template
+        shard_size (int): if set, write the items to pages of this many
+            roots each and a table of contents to output
+            (see :func:`render_shards`)
+        store_type (str): 'json' to use output.json as the item cache
+            or 'sqlite' to store items in output.sqlite (importing
+            output.json the first time) and only write output.json if
+            export_json is True (default: 'json')
+        export_json (bool): True to write output.json with store_type
+            'sqlite' (default: False)
+        per_user (bool): with several usernames, True to write an archive
+            for each user (see :func:`get_user_output`) instead of one
+            combined archive. Items are fetched once for all users
+            either way. (default: False)
+        fetched (dict): items already fetched by this process, keyed by id
+            (see :func:`get_items`)
+        metrics (Metrics): add timings and counters to this
+            instead of to a new :class:`Metrics`
+        return_metrics (bool): True to also return the metrics
+            (default: False)
+        json_compression (str): 'gz' or 'zst' to write output.json.gz
+            or output.json.zst instead of output.json
+            (an existing archive is read with any compression)
+        lazy (bool): True to write the collapsed subtrees which don't
+            contain the users' items to ``<output>.chunks/`` and load them
+            when they're expanded instead of including them in the page
+            (see :func:`render_chunks`) (default: False)
+        resume (bool): True to resume an interrupted crawl: items in
+            ``<output>.journal`` are not fetched again
+            (see :class:`CrawlJournal`) (default: False)
+        max_depth (int): only crawl replies this many levels below
+            the users' items (see :func:`get_items`)
+        max_kids (int): only crawl the first max_kids replies to each item
+        max_items (int): stop crawling replies after this many items
+        max_seconds (float): stop crawling replies after this many seconds
+
+    Returns:
+        str: HTML output (or None if not return_html or shard_size),
+            or a list of them with per_user;
+            or a (output, metrics_dict) tuple with return_metrics
+            (see :meth:`Metrics.to_dict`)
+
+    Raises:
+        Exception: ...
+    """
+    global METRICS
+    if metrics is None:
+        metrics = Metrics()
+    METRICS = metrics
+    start = metrics.clock()
+
+    usernames = get_usernames(username)
+    if per_user and len(usernames) > 1:
+        if fetched is None:
+            fetched = {}
+        outputs = [get_user_output(output, _username)
+                   for _username in usernames]
+        for _output in outputs:
+            if os.path.dirname(_output):
+                os.makedirs(os.path.dirname(_output), exist_ok=True)
+        htmls = [
+            dlhn(_username, output=_output,
+                 inputjson=inputjson,
+                 inputjson_upgrade=inputjson_upgrade,
+                 jobs=jobs,
+                 incremental=incremental,
+                 return_html=return_html,
+                 template=template,
+                 shard_size=shard_size,
+                 store_type=store_type,
+                 export_json=export_json,
+                 fetched=fetched,
+                 metrics=metrics,
+                 json_compression=json_compression,
+                 lazy=lazy,
+                 resume=resume,
+                 max_depth=max_depth,
+                 max_kids=max_kids,
+                 max_items=max_items,
+                 max_seconds=max_seconds)
+            for _username, _output in zip(usernames, outputs)]
+        if return_metrics:
+            return htmls, metrics.to_dict()
+        return htmls
+
+    build_requests_session(os.path.dirname(output))
+    build_clean_memo(os.path.dirname(output))
+    build_fragment_memo(os.path.dirname(output))
+    ratelimiter = getattr(REQUESTS, 'ratelimiter', None)
+    throttled = ratelimiter.throttled if ratelimiter else 0.0
+
+    output_json = '%s.json' % output
+    if json_compression:
+        output_json = '%s.%s' % (output_json, json_compression)
+    cache_json = find_json(output_json)
+    datasource = inputjson if inputjson else 'HN API'
+    log.info(
+        "Reading data from %r%s into %r%s and then templating to %r",
+        datasource,
+        ((' for users %r' % usernames) if usernames else ''),
+        output_json,
+        (', upgrading the JSON,' if inputjson_upgrade and inputjson else ''),
+        output)
+
+
+    cache = None
+    _data = {}
+    store = None
+    if store_type == 'sqlite' and inputjson is None:
+        store_path = '%s.sqlite' % output
+        store = ItemStore(store_path)
+        if not len(store) and cache_json is not None:
+            log.info(u'Importing %r into %r' % (cache_json, store_path))
+            _data = read_json(cache_json)
+            store.update(_data['items'])
+            store.set_data(_data)
+        _data = store.get_data()
+        if len(store):
+            cache = store
+            log.info(u'Reading cache from %r' % store_path)
+    elif cache_json is not None:
+        _data = read_json(cache_json)
+        cache = _data.get('items')
+        log.info(u'Reading cache from %r (%d)' %
+                 (cache_json, len(cache)))
+
+    upgraded = False
+    if inputjson is None:
+        cache_clean = is_data_current(_data)
+        if incremental and cache is not None and not cache_clean:
+            # merged items aren't revisited, so upgrade them first
+            if store is not None:
+                _items = collections.OrderedDict(store.items())
+                upgrade_items(_items, jobs=jobs)
+                store.update(_items)
+            else:
+                upgrade_items(cache, jobs=jobs)
+            cache_clean = True
+        if fetched is None and (len(usernames) > 1 or resume):
+            fetched = {}
+        journal = CrawlJournal('%s.journal' % output)
+        if resume:
+            resumed = journal.load()
+            log.info("Resuming the crawl with %d items from %r",
+                     len(resumed), journal.path)
+            metrics.incr('journal_items', len(resumed))
+            fetched.update(resumed)
+        journal.open(resume=resume)
+        items = None
+        roots = []
+        submitted = collections.OrderedDict()
+        with metrics.phase('crawl'), contextlib.closing(journal), \
+                flushing(getattr(REQUESTS, 'created', None)):
+            for username in usernames:
+                user = get_user(username)
+                user_items, user_roots = get_items(
+                    username, cache=cache, jobs=jobs,
+                    user=user,
+                    incremental=incremental,
+                    submitted=_data.get('submitted', {}).get(username),
+                    cache_clean=cache_clean,
+                    fetched=fetched,
+                    journal=journal,
+                    max_depth=max_depth,
+                    max_kids=max_kids,
+                    max_items=max_items,
+                    max_seconds=max_seconds)
+                if items is None:
+                    items = user_items
+                else:
+                    items.update(user_items)
+                roots = merge_roots(roots, user_roots)
+                submitted[username] = list(user.get('submitted') or [])
+        items = sort_items(
+            items if items is not None else collections.OrderedDict())
+        merge = incremental and cache is not None
+        if store is not None:
+            if merge:
+                # refetched parents are newer than their copies in the store
+                items.update(link_kids(
+                    items, lambda key: items.get(key) or store.get(key)))
+                roots = merge_roots(_data.get('roots', []), roots)
+            store.update(items, clear=not merge)
+            items = store
+        elif merge:
+            items, roots = merge_items(
+                cache, _data.get('roots', []), items, roots)
+        if merge:
+            # order the roots like a full crawl would
+            user_roots = []
+            for username in usernames:
+                user_roots = merge_roots(user_roots, get_submitted_roots(
+                    items.get, submitted[username]))
+            roots = merge_roots(roots, user_roots)
+        data = collections.OrderedDict()
+        data['usernames'] = usernames
+        data['items'] = items
+        data['roots'] = roots
+        data['submitted'] = submitted
+        data['meta'] = get_data_meta()
+        if store is not None:
+            store.set_data(data)
+    else:
+        log.info("Loading JSON from %r" % inputjson)
+        data = read_json(inputjson)
+
+        required_attrs = ('usernames', 'items', 'roots')
+        missing_attrs = []
+        for attr in required_attrs:
+            if attr not in data:
+                missing_attrs.append(attr)
+        if missing_attrs:
+            raise ValueError(
+                'inputjson does not have attrs: %r' % missing_attrs)
+
+        if inputjson_upgrade:
+            upgraded = upgrade_data(data, jobs=jobs)
+
+    data = normalize_data(data)
+    metrics.peak('items_peak', len(data['items']))
+    if store is not None:
+        write_output_json = export_json
+    else:
+        write_output_json = inputjson is None or (
+            inputjson_upgrade is True and (
+                upgraded or not os.path.exists(output_json)
+                or not os.path.samefile(inputjson, output_json)))
+    if write_output_json:
+        log.info("Writing JSON to %r" % output_json)
+        write_json(data, output_json)
+    if inputjson is None:
+        journal.remove()
+
+    html = None
+    if return_html and not shard_size:
+        if lazy:
+            lazy_chunks = render_chunks(data, output, template=template)
+            if lazy_chunks is not None:
+                data['lazy_chunks'] = lazy_chunks
+        log.info("Generating HTML with template")
+        with metrics.phase('render'):
+            html = get_template(template).render(
+                get_template_data(data, template=template))
+
+            log.info("Writing HTML to %r" % output)
+            with codecs.open(output, 'w', encoding='utf8') as _file:
+                _file.write(html)
+    else:
+        write_html(data, output, template=template, shard_size=shard_size,
+                   lazy=lazy)
+
+    CLEAN_MEMO.flush()
+    FRAGMENT_MEMO.flush()
+    if getattr(REQUESTS, 'created', None) is not None:
+        REQUESTS.created.flush()
+    if ratelimiter is not None:
+        log.info("Spent %.3fs throttled",
+                 ratelimiter.throttled - throttled)
+    metrics.add_time('total', metrics.clock() - start)
+    if return_metrics:
+        return html, metrics.to_dict()
+    return html
+
+
+def write_html(data, output, template=None, shard_size=None, lazy=False):
+    """
+    Stream the HTML for data to output (see :func:`render_html`)
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+        output (str): path to write HTML to
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+        shard_size (int): if set, write pages of this many roots each
+            and a table of contents (see :func:`render_shards`)
+        lazy (bool): True to write collapsed subtrees to chunks
+            (see :func:`render_chunks`)
+    """
+    if shard_size:
+        render_shards(data, output, shard_size, template=template,
+                      lazy=lazy)
+        return
+    if lazy:
+        lazy_chunks = render_chunks(data, output, template=template)
+        if lazy_chunks is not None:
+            data = collections.OrderedDict(data)
+            data['lazy_chunks'] = lazy_chunks
+    log.info("Streaming HTML from template to %r" % output)
+    render_html(data, output, template=template)
+
+
+def get_updates():
+    """
+    Get the ids of the items and profiles that changed recently
+    from the HN API
 
     Returns:
-        str: HTML output
+        dict: {'items': [...], 'profiles': [...]}
+    """
+    url = (
+        '{}/updates.json?nonce={}'
+        .format(HN_API_URL, datetime.datetime.now().isoformat()))
+    return get_json(url) or {}
+
+
+class Watcher(object):
+    """
+    Keep an archive up to date (``dlhn --watch``)
+
+    The requests session, compiled template, and the archive's items stay
+    in memory between polls. Each :meth:`poll` gets the users' profiles
+    and the API's updates (see :func:`get_updates`), fetches only new
+    submissions, changed items in the archive, and their new replies
+    (other items are taken from memory), and rewrites the JSON and HTML
+    (each atomically) only if an item changed.
+
+    The updates endpoint only lists the items that changed in the last
+    few minutes, so the poll interval should be shorter than that.
+    """
+
+    def __init__(self, username, output='index.html', jobs=1,
+                 template=None, shard_size=None, json_compression=None,
+                 lazy=False, **kwargs):
+        """
+        Args:
+            username (str): hackernews username (or a list of usernames)
+
+        Kwargs:
+            output (str): path to write HTML to (and JSON to output.json)
+            kwargs: see :func:`dlhn` (e.g. max_depth)
+        """
+        self.usernames = get_usernames(username)
+        self.output = output
+        self.jobs = jobs
+        self.template = template
+        self.shard_size = shard_size
+        self.json_compression = json_compression
+        self.lazy = lazy
+        self.kwargs = kwargs
+        self.data = None
+
+    @property
+    def output_json(self):
+        output_json = '%s.json' % self.output
+        if self.json_compression:
+            output_json = '%s.%s' % (output_json, self.json_compression)
+        return output_json
+
+    def start(self):
+        """
+        Update the archive with :func:`dlhn` and load it
+        """
+        dlhn(self.usernames, output=self.output, jobs=self.jobs,
+             template=self.template, shard_size=self.shard_size,
+             json_compression=self.json_compression, lazy=self.lazy,
+             return_html=False, **self.kwargs)
+        self.data = normalize_data(read_json(self.output_json))
+
+    def poll(self):
+        """
+        Fetch the new and changed items and rewrite the archive
+        if any of them changed
+
+        Returns:
+            list: ids of the items that were added or changed
+        """
+        items = self.data['items']
+        updated = set(get_updates().get('items') or [])
+        changed = set(itemid for itemid in updated if str(itemid) in items)
+        submitted = self.data.setdefault(
+            'submitted', collections.OrderedDict())
+        expanded = get_expanded_ids(
+            items, [itemid for username in self.usernames
+                    for itemid in submitted.get(username, [])])
+        queues = collections.OrderedDict(
+            (username, []) for username in self.usernames)
+        for username in self.usernames:
+            user = get_user(username)
+            if not user:
+                continue
+            previous = set(submitted.get(username) or [])
+            queues[username].extend(
+                itemid for itemid in user.get('submitted') or []
+                if itemid not in previous)
+            submitted[username] = list(user.get('submitted') or [])
+        queues[self.usernames[0]].extend(
+            itemid if itemid in expanded else (itemid, 'parent')
+            for itemid in sorted(changed, reverse=True))
+
+        # changed items are fetched; other items are taken from memory
+        cache = dict(
+            (key, item) for key, item in items.items()
+            if int(key) not in changed)
+        scope = dict(
+            (key, self.kwargs[key]) for key in
+            ('max_depth', 'max_kids', 'max_items', 'max_seconds')
+            if key in self.kwargs)
+        modified = []
+        roots = []
+        fetched = {}
+        with flushing(getattr(REQUESTS, 'created', None)):
+            for username, queue in queues.items():
+                if not queue:
+                    continue
+                user_items, user_roots = get_items(
+                    username, cache=cache, jobs=self.jobs,
+                    user={'submitted': queue}, cache_clean=True,
+                    fetched=fetched, cache_before=float('inf'), **scope)
+                for itemid, item in user_items.items():
+                    if items.get(str(itemid)) != item:
+                        items[str(itemid)] = item
+                        modified.append(itemid)
+                link_kids(user_items, lambda key: items.get(str(key)))
+                roots = merge_roots(roots, user_roots)
+        if not modified:
+            log.info("No changes")
+            return modified
+
+        known = set(self.data['roots'])
+        self.data['roots'] = [
+            rootid for rootid in roots if rootid not in known
+        ] + self.data['roots']
+        for key in sorted(items, key=int):
+            items.move_to_end(key)
+        log.info("Updating %d items", len(modified))
+        write_json(self.data, self.output_json)
+        write_html(self.data, self.output, template=self.template,
+                   shard_size=self.shard_size, lazy=self.lazy)
+        for memo in (CLEAN_MEMO, FRAGMENT_MEMO,
+                     getattr(REQUESTS, 'created', None)):
+            if memo is not None:
+                memo.flush()
+        return modified
+
+    def run(self, interval=60, iterations=None, sleep=time.sleep):
+        """
+        :meth:`start` and then :meth:`poll` every interval seconds
+
+        Kwargs:
+            interval (float): seconds between polls
+            iterations (int): number of polls (default: poll forever)
+            sleep (callable): sleep function (e.g. for tests)
+        """
+        self.start()
+        n = 0
+        while iterations is None or n < iterations:
+            sleep(interval)
+            n += 1
+            try:
+                self.poll()
+            except Exception:
+                log.exception('Poll failed; retrying in %ss', interval)
+
+
+def get_usernames(username):
+    """
+    Args:
+        username (str): a username, comma-separated usernames,
+            a list of them, or None
+
+    Returns:
+        list: usernames
+    """
+    if username is None:
+        return []
+    if isinstance(username, (list, tuple)):
+        return [name for _username in username
+                for name in get_usernames(_username)]
+    return [name.strip() for name in username.split(',') if name.strip()]
+
+
+def get_user_output(output, username):
+    """
+    Get the output path for one user's archive with ``per_user``
+
+    Args:
+        output (str): output path; ``{username}`` is replaced with
+            the username, if present (e.g. ``{username}/index.html``);
+            otherwise the username is appended to the filename
+            (e.g. ``index-dlhntestuser.html``)
+        username (str): hackernews username
+
+    Returns:
+        str: output path
+    """
+    if '{username}' in output:
+        return output.replace('{username}', username)
+    stem, ext = os.path.splitext(output)
+    return '%s-%s%s' % (stem, username, ext)
+
+
+def clean_texts(texts):
+    """
+    Clean each text with CLEANER (in a worker process with jobs > 1)
+
+    Args:
+        texts (list): HTML strings
+
+    Returns:
+        list: (cleaned_text, None) or (None, error_repr) tuples
+    """
+    results = []
+    for text in texts:
+        try:
+            results.append((build_cleaner().clean(text), None))
+        except ValueError as e:
+            results.append((None, repr(e)))
+    return results
+
+
+SCHEMA_VERSION = 1
+
+
+def get_data_meta():
+    """
+    Get the schema and sanitizer versions to store in data['meta']
+
+    Returns:
+        OrderedDict: {'schema': SCHEMA_VERSION, 'sanitizer': hash}
+    """
+    meta = collections.OrderedDict()
+    meta['schema'] = SCHEMA_VERSION
+    meta['sanitizer'] = get_sanitizer_version()
+    return meta
+
+
+def is_data_current(data):
+    """
+    Returns:
+        bool: True if data's item texts were all sanitized by the
+            current sanitizer (see :func:`get_sanitizer_version`)
+    """
+    meta = data.get('meta') or {}
+    return meta.get('sanitizer') == get_sanitizer_version()
+
+
+def upgrade_data(data, jobs=1):
+    """
+    Upgrade data (e.g. from index.html.json) to the current schema
+    and sanitizer version in place
+
+    Item texts are only sanitized again if data['meta'] records an
+    older sanitizer version (or none).
+
+    Args:
+        data (dict): dict with 'usernames', 'items', and 'roots'
+
+    Kwargs:
+        jobs (int): number of processes to clean texts with
+
+    Returns:
+        bool: True if data was modified
+    """
+    meta = data.get('meta') or {}
+    if meta.get('schema') == SCHEMA_VERSION and is_data_current(data):
+        log.info("JSON is up to date (schema %r)" % SCHEMA_VERSION)
+        return False
+    if not is_data_current(data):
+        log.info("Upgrading item texts from sanitizer %r"
+                 % meta.get('sanitizer'))
+        upgrade_items(data['items'], jobs=jobs)
+    data['meta'] = get_data_meta()
+    return True
+
+
+def upgrade_items(items, jobs=1, chunksize=500):
+    """
+    Sanitize the text of each comment in items in place
+    (skipping texts that are already in CLEAN_MEMO)
+
+    Args:
+        items (dict): items keyed by str(id)
+
+    Kwargs:
+        jobs (int): number of processes to clean texts with.
+            With jobs > 1, texts are cleaned in chunks by a process pool
+            and merged back in order, so the output is the same.
+        chunksize (int): maximum number of texts per chunk
+    """
+    itemids = []
+    texts = []
+    for itemid, item in items.items():
+        # item = data['items'].get(str(itemid))
+        if item is None:
+            log.error('itemid %r is not in data["items"]'
+                      % itemid)
+        elif item.get('type') == 'comment':
+            if 'text' not in item:
+                if item.get('deleted') != True:
+                    log.error(
+                        ('itemid %r does not have a "text" attr'
+                            % itemid, item))
+            else:
+                cleaned = None
+                if CLEAN_MEMO is not None:
+                    cleaned = CLEAN_MEMO.get('clean', item['text'])
+                if cleaned is not None:
+                    item['text'] = cleaned
+                    METRICS.incr('sanitize_memo_hits')
+                else:
+                    itemids.append(itemid)
+                    texts.append(item['text'])
+
+    with METRICS.phase('sanitize'):
+        if jobs > 1 and len(texts) > chunksize:
+            chunksize = min(chunksize, -(-len(texts) // (jobs * 4)))
+            chunks = [texts[n:n+chunksize]
+                      for n in range(0, len(texts), chunksize)]
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs) as pool:
+                results = [result
+                           for chunk in pool.map(clean_texts, chunks)
+                           for result in chunk]
+        else:
+            results = clean_texts(texts)
+    METRICS.incr('sanitized', len(texts))
+
+    for itemid, text, (cleaned, error) in zip(itemids, texts, results):
+        if error is not None:
+            log.error(('itemid %r' % itemid, error))
+            log.error(('item[text]', text))
+        else:
+            items[itemid]['text'] = cleaned
+            if CLEAN_MEMO is not None:
+                CLEAN_MEMO.set('clean', text, cleaned)
+
+
+def normalize_data(data):
+    """
+    Normalize data the way a JSON round trip would (str item keys),
+    so that the template gets the same data whether it was just
+    crawled or loaded from JSON
+
+    An OrderedDict of items is re-keyed in place (in the same order)
+    instead of copied, so that a large archive isn't held twice.
+
+    Args:
+        data (dict): dict with 'usernames', 'items', and 'roots'
+            (items may be an ItemStore, which already has str keys)
+
+    Returns:
+        OrderedDict: data with str item keys
+    """
+    data = collections.OrderedDict(data)
+    items = data['items']
+    if isinstance(items, ItemStore):
+        return data
+    if not isinstance(items, collections.OrderedDict):
+        items = data['items'] = collections.OrderedDict(items)
+    for key in list(items):
+        if not isinstance(key, str):
+            items[str(key)] = items.pop(key)
+        else:
+            items.move_to_end(key)
+    return data
+
+
+JSON_BACKEND = 'auto'
+
+
+def get_json_backend(backend=None):
+    """
+    Get the JSON module to read and write archives with
+
+    Kwargs:
+        backend (str): 'json' (the standard library), 'orjson',
+            or 'auto' to use orjson if it's installed
+            (default: JSON_BACKEND)
+
+    Returns:
+        module: json or orjson
+    """
+    if backend is None:
+        backend = JSON_BACKEND
+    if backend in ('auto', 'orjson'):
+        try:
+            import orjson
+            return orjson
+        except ImportError:
+            if backend == 'orjson':
+                raise
+    return json
+
+
+@lru_cache(maxsize=4096)
+def _escape_json_chars(chars):
+    """
+    Returns:
+        str: chars escaped as ``\\uXXXX`` (with surrogate pairs),
+            like json.dumps does
+    """
+    escaped = []
+    for char in chars:
+        code = ord(char)
+        if code > 0xffff:
+            code -= 0x10000
+            escaped.append('\\u%04x\\u%04x' % (
+                0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff)))
+        else:
+            escaped.append('\\u%04x' % code)
+    return ''.join(escaped)
+
+
+def _escape_json_errors(error):
+    """
+    A codecs error handler which escapes the characters that can't be
+    encoded (see :func:`_escape_json_chars`)
+    """
+    return _escape_json_chars(error.object[error.start:error.end]), error.end
+
+
+codecs.register_error('dlhn.escape_json', _escape_json_errors)
+
+
+def dumps_orjson(obj, orjson):
+    """
+    Returns:
+        bytes: obj as JSON indented by 2 spaces, with non-ASCII characters
+            escaped like json.dumps does (orjson writes them as UTF-8), so
+            that the archive's bytes don't depend on which backend is
+            installed
+    """
+    content = orjson.dumps(obj, default=json_default,
+                           option=orjson.OPT_INDENT_2)
+    if not content.isascii():
+        content = content.decode('utf8').encode('ascii', 'dlhn.escape_json')
+    if b'\x7f' in content:
+        content = content.replace(b'\x7f', b'\\u007f')
+    return content
+
+
+def dumps_json(obj, backend=None):
+    """
+    Returns:
+        str: obj as JSON indented by 2 spaces
+            (the same with either backend)
+    """
+    _json = get_json_backend(backend)
+    if _json is json:
+        return json.dumps(obj, indent=2, default=json_default)
+    return dumps_orjson(obj, _json).decode('ascii')
+
+
+def read_json(path, backend=None):
+    """
+    Read data written by :func:`write_json` (e.g. index.html.json),
+    decompressing .gz and .zst files (detected by their first bytes)
+
+    Args:
+        path (str): path to read JSON from
+
+    Kwargs:
+        backend (str): see :func:`get_json_backend`
+
+    Returns:
+        OrderedDict: data, with data['items'] as an OrderedDict of
+            :class:`Item`
+    """
+    with METRICS.phase('json_read'):
+        with open(path, 'rb') as _file:
+            content = _file.read()
+        if content[:2] == b'\x1f\x8b':
+            content = gzip.decompress(content)
+        elif content[:4] == b'\x28\xb5\x2f\xfd':
+            import zstandard
+            content = zstandard.ZstdDecompressor().decompressobj().decompress(
+                content)
+        data = get_json_backend(backend).loads(content)
+        del content
+        data = collections.OrderedDict(data)
+        items = data.get('items')
+        if isinstance(items, dict):
+            # convert (and release) the item dicts one at a time
+            data['items'] = collections.OrderedDict(
+                (key, Item.from_json(items.pop(key))) for key in list(items))
+    return data
+
+
+JSON_COMPRESSIONS = ('gz', 'zst')
+
+
+def find_json(path):
+    """
+    Find an existing archive for path, which may have been written
+    with a different compression (see JSON_COMPRESSIONS)
+
+    Args:
+        path (str): e.g. index.html.json or index.html.json.gz
+
+    Returns:
+        str: path if it exists, or the path of an existing
+            (un)compressed variant of it, or None
+    """
+    base = path
+    for ext in JSON_COMPRESSIONS:
+        if base.endswith('.' + ext):
+            base = base[:-len(ext) - 1]
+    for _path in [path, base] + ['%s.%s' % (base, ext)
+                                 for ext in JSON_COMPRESSIONS]:
+        if os.path.exists(_path):
+            return _path
+    return None
+
+
+def write_json(data, path, bufsize=1024*1024, backend=None,
+               batchsize=1000):
+    """
+    Write data to path as indented JSON
+    (compressed if path ends with .gz or .zst; see :func:`open_atomic`)
+
+    With the standard library json backend, json.dump writes the encoded
+    chunks through a buffered file (without building the whole string
+    in memory); with orjson, which is faster, the items are encoded and
+    written batchsize at a time. Both write the same bytes
+    (see :func:`dumps_orjson`). Either way the JSON is written to a
+    temporary file so that a failed write doesn't clobber the existing
+    JSON (which is also the item cache).
+
+    If data['items'] is an ItemStore, the items are read from it and
+    written one at a time in the same format.
+
+    Args:
+        data (dict): data to serialize
+        path (str): path to write JSON to
+
+    Kwargs:
+        bufsize (int): write buffer size in bytes
+        backend (str): see :func:`get_json_backend`
+        batchsize (int): number of items to encode at a time
+            (with orjson or from an ItemStore)
+    """
+    _json = get_json_backend(backend)
+    with METRICS.phase('json_write'), \
+            open_atomic(path, bufsize=bufsize) as _file:
+        if _json is json and not isinstance(data.get('items'), ItemStore):
+            json.dump(data, _file, indent=2, default=json_default)
+            return
+        _file.write('{')
+        n = -1
+        for n, (key, value) in enumerate(data.items()):
+            _file.write('%s\n  %s: ' % (',' if n else '', json.dumps(key)))
+            if key != 'items':
+                _file.write(
+                    dumps_json(value, backend).replace('\n', '\n  '))
+                continue
+            _file.write('{')
+            # encode batchsize items at a time, without the braces
+            pairs = iter(value.items())
+            m = -1
+            for m in itertools.count():
+                batch = collections.OrderedDict(
+                    itertools.islice(pairs, batchsize))
+                if not batch:
+                    break
+                _file.write('%s\n  %s' % (
+                    ',' if m else '',
+                    dumps_json(batch, backend)[2:-2].replace('\n', '\n  ')))
+            _file.write('\n  }' if m > 0 else '}')
+        _file.write('\n}' if n >= 0 else '}')
+
+
+def render_html(data, path, template=None,
+                bufsize=1024*1024, chunksize=64):
+    """
+    Render the template with data and write it to path in chunks
+    (with Template.stream) instead of building the whole page in memory
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+        path (str): path to write HTML to
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+        bufsize (int): write buffer size in bytes
+        chunksize (int): number of template events to buffer per write
+    """
+    with METRICS.phase('render'):
+        stream = get_template(template).stream(
+            get_template_data(data, template=template))
+        stream.enable_buffering(size=chunksize)
+        with open_atomic(path, bufsize=bufsize) as _file:
+            stream.dump(_file)
+
+
+def get_subtree_digest(items, rootid):
+    """
+    Get a hash of the items in the subtree under rootid
+
+    Args:
+        items (dict): items keyed by str(id)
+        rootid (int): item id
+
+    Returns:
+        str: hex digest
+    """
+    subtree = [Item.from_json(items[str(itemid)]).astuple()
+               for itemid in get_subtree_ids(items, [rootid])]
+    return hashlib.sha256(repr(subtree).encode('utf8')).hexdigest()
+
+
+def make_root_fragment(data, template=None, memo=None, flush_every=1000):
+    """
+    Make a ``root_fragment(itemid)`` function for the template, which
+    returns the HTML of the subtree under a root from memo or renders it
+    with the template's ``render_items`` macro (and adds it to memo)
+
+    Fragments are keyed by the template version, the usernames, and
+    the root id, and stored with a hash of the subtree's items (see
+    :func:`get_subtree_digest`), so only the subtrees with changed items
+    are rendered again and a changed subtree replaces its old fragment.
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+        memo (CleanMemo): fragment memo (default: FRAGMENT_MEMO)
+        flush_every (int): flush memo after this many new fragments
+
+    Returns:
+        callable: root_fragment function, or None if there is no memo
+            or the template doesn't define ``render_items``
+    """
+    memo = FRAGMENT_MEMO if memo is None else memo
+    if memo is None:
+        return None
+    module = get_template(template).make_module(
+        dict(data, str=str, roots=[]))
+    render_items = getattr(module, 'render_items', None)
+    if render_items is None:
+        return None
+    items = data['items']
+    prefix = u'%s %s ' % (
+        get_template_version(template), json.dumps(data['usernames']))
+    lazy_chunks = data.get('lazy_chunks')
+    if lazy_chunks is not None:
+        # chunk hrefs are '<output>.chunks/<rootid>.js'
+        prefix += u'lazy %s ' % json.dumps(sorted(set(
+            href.rsplit('/', 1)[0] for href in lazy_chunks.values())))
+
+    def root_fragment(itemid):
+        key = prefix + str(itemid)
+        digest = get_subtree_digest(items, itemid)
+        value = memo.get('fragment', key)
+        if value is not None:
+            memo_digest, _, html = value.partition(u'\n')
+            if memo_digest == digest:
+                METRICS.incr('fragment_hits')
+                return html
+        html = u'%s' % render_items([itemid])
+        METRICS.incr('fragments_rendered')
+        memo.set('fragment', key, digest + u'\n' + html)
+        if len(memo.pending) >= flush_every:
+            memo.flush()
+        return html
+    return root_fragment
+
+
+def get_template_data(data, template=None):
+    """
+    Get the template context for data: data, ``str``, and
+    ``root_fragment`` (see :func:`make_root_fragment`) if
+    the items are shown
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+
+    Returns:
+        dict: template context
+    """
+    context = dict(data, str=str)
+    if data.get('show_items', True):
+        root_fragment = make_root_fragment(data, template=template)
+        if root_fragment is not None:
+            context['root_fragment'] = root_fragment
+    return context
+
+
+def get_subtree_ids(items, roots):
+    """
+    Get the ids of the items in the subtrees under roots
+    (the items that the template renders for roots)
+
+    Args:
+        items (dict): items keyed by str(id)
+        roots (list): item ids
+
+    Returns:
+        list: item ids in depth-first order
+    """
+    ids = []
+    seen = set()
+    stack = list(reversed(roots))
+    while stack:
+        itemid = stack.pop()
+        if itemid in seen:
+            continue
+        item = items.get(str(itemid))
+        if item is None:
+            continue
+        seen.add(itemid)
+        ids.append(itemid)
+        stack.extend(reversed(item.get('kids', [])))
+    return ids
+
+
+def render_shards(data, output, shard_size, template=None, lazy=False):
+    """
+    Render the roots and their subtrees to pages of shard_size roots each
+    (``index-0001.html``, ``index-0002.html``, ...) and a table of contents
+    page linking to them at output
+
+    Roots are assigned to shards by id, oldest first, so that new roots
+    and new replies in old threads (which move a root to the front of
+    ``data['roots']``) don't move other roots between shards. Each shard
+    lists its roots in ``data['roots']`` order. A hash of the template, the usernames, and
+    each shard's roots and items (see :func:`get_subtree_digest`) is stored
+    in ``<output>.shards.json``; shards whose hash hasn't changed are not
+    rendered again (e.g. when only ``data['submitted']`` changed).
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+        output (str): path to write the table of contents HTML to
+        shard_size (int): number of roots per page
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+        lazy (bool): True to write the collapsed subtrees of each shard
+            to chunks (see :func:`render_chunks`)
+
+    Returns:
+        list: paths of the shards that were rendered
+    """
+    stem, ext = os.path.splitext(output)
+    manifest_path = '%s.shards.json' % output
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with codecs.open(manifest_path, 'r', encoding='utf8') as _file:
+            manifest = json.load(_file)
+
+    template_version = get_template_version(template)
+    shard_numbers = dict(
+        (rootid, m // shard_size)
+        for m, rootid in enumerate(sorted(data['roots'])))
+    shards = [[] for m in range(0, len(data['roots']), shard_size)]
+    for rootid in data['roots']:
+        shards[shard_numbers[rootid]].append(rootid)
+    root_hrefs = {}
+    shards_manifest = collections.OrderedDict()
+    rendered = []
+    for n, shard_roots in enumerate(shards):
+        path = '%s-%04d%s' % (stem, n + 1, ext)
+        filename = os.path.basename(path)
+        for rootid in shard_roots:
+            root_hrefs[rootid] = filename
+
+        shard_data = collections.OrderedDict(data)
+        shard_data['roots'] = shard_roots
+        shard_data['items'] = collections.OrderedDict(
+            (str(itemid), data['items'][str(itemid)])
+            for itemid in get_subtree_ids(data['items'], shard_roots))
+        digest = hashlib.sha256(u' '.join(
+            [template_version, json.dumps(data['usernames']),
+             json.dumps(shard_roots)]
+            + [get_subtree_digest(data['items'], rootid)
+               for rootid in shard_roots]
+            + (['lazy'] if lazy else [])).encode('utf8')).hexdigest()
+        shards_manifest[filename] = digest
+        if manifest.get(filename) == digest and os.path.exists(path):
+            continue
+        if lazy:
+            shard_data['lazy_chunks'] = render_chunks(
+                shard_data, path, template=template)
+        log.info("Writing HTML shard to %r" % path)
+        render_html(shard_data, path, template=template)
+        rendered.append(path)
+
+    basedir = os.path.dirname(output)
+    for filename in set(manifest) - set(shards_manifest):
+        path = os.path.join(basedir, filename)
+        if os.path.exists(path):
+            log.info("Removing HTML shard %r" % path)
+            os.remove(path)
+        remove_chunks(path)
+
+    index_data = collections.OrderedDict(data)
+    index_data['root_hrefs'] = root_hrefs
+    index_data['show_items'] = False
+    log.info("Writing HTML contents to %r" % output)
+    render_html(index_data, output, template=template)
+    write_json(shards_manifest, manifest_path)
+    return rendered
+
+
+def get_lazy_ids(data):
+    """
+    Get the outermost collapsed items (items by other users with a parent)
+    whose subtrees don't contain any of the users' items
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+
+    Returns:
+        OrderedDict: {rootid: [itemid, ...]} in depth-first order
+    """
+    items = data['items']
+    usernames = set(data['usernames'])
+    lazy_ids = collections.OrderedDict()
+    for rootid in data['roots']:
+        ids = get_subtree_ids(items, [rootid])
+        has_own = set()
+        for itemid in reversed(ids):
+            item = items[str(itemid)]
+            if item.get('by') in usernames or any(
+                    kid in has_own for kid in item.get('kids', ())):
+                has_own.add(itemid)
+        root_lazy_ids = []
+        skip = set()
+        for itemid in ids:
+            item = items[str(itemid)]
+            if itemid in skip or (
+                    itemid not in has_own and item.get('parent')):
+                if itemid not in skip:
+                    root_lazy_ids.append(itemid)
+                skip.update(item.get('kids', ()))
+        if root_lazy_ids:
+            lazy_ids[rootid] = root_lazy_ids
+    return lazy_ids
+
+
+def remove_chunks(output):
+    """
+    Remove the chunks written by :func:`render_chunks` for output
+    """
+    chunkdir = '%s.chunks' % output
+    if os.path.isdir(chunkdir):
+        log.info("Removing HTML chunks %r" % chunkdir)
+        shutil.rmtree(chunkdir)
+    if os.path.exists('%s.chunks.json' % output):
+        os.remove('%s.chunks.json' % output)
+
+
+def render_chunks(data, output, template=None):
+    """
+    Render the collapsed subtrees without the users' items
+    (see :func:`get_lazy_ids`) to a script per root,
+    ``<output>.chunks/<rootid>.js``, which calls
+    ``dlhnChunk({"<type>-<id>": "<html>", ...})``
+
+    Pass the returned hrefs to the template as ``lazy_chunks`` to render
+    placeholders for these subtrees, which the page replaces with the
+    chunk's HTML when they're expanded. (Chunks are scripts instead of
+    JSON so that they also load in pages opened from ``file://`` URLs.)
+
+    A hash of each root's items and the template is stored in
+    ``<output>.chunks.json``; chunks whose hash hasn't changed are not
+    rendered again.
+
+    Args:
+        data (dict): normalized data (see :func:`normalize_data`)
+        output (str): path of the HTML page which loads the chunks
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+
+    Returns:
+        dict: {itemid: chunk href} or None if the template doesn't
+            define ``render_items``
+    """
+    module = get_template(template).make_module(
+        dict(data, str=str, roots=[]))
+    render_items = getattr(module, 'render_items', None)
+    if render_items is None:
+        log.warning("The template doesn't define render_items;"
+                    " not writing HTML chunks")
+        return None
+
+    chunkdir = '%s.chunks' % output
+    manifest_path = '%s.chunks.json' % output
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with codecs.open(manifest_path, 'r', encoding='utf8') as _file:
+            manifest = json.load(_file)
+
+    items = data['items']
+    prefix = u'%s %s ' % (
+        get_template_version(template), json.dumps(data['usernames']))
+    lazy_chunks = {}
+    chunks_manifest = collections.OrderedDict()
+    for rootid, lazy_ids in get_lazy_ids(data).items():
+        filename = '%s.js' % rootid
+        href = '%s/%s' % (os.path.basename(chunkdir), filename)
+        for itemid in lazy_ids:
+            lazy_chunks[itemid] = href
+        digest = hashlib.sha256((
+            prefix + get_subtree_digest(items, rootid)).encode('utf8')
+        ).hexdigest()
+        chunks_manifest[filename] = digest
+        path = os.path.join(chunkdir, filename)
+        if manifest.get(filename) == digest and os.path.exists(path):
+            continue
+        if not os.path.isdir(chunkdir):
+            os.makedirs(chunkdir)
+        chunk = collections.OrderedDict()
+        for itemid in lazy_ids:
+            item = items[str(itemid)]
+            chunk['%s-%s' % (item['type'], itemid)] = u'%s' % (
+                render_items([itemid]))
+        with open_atomic(path) as _file:
+            _file.write(u'dlhnChunk(%s);\n' % json.dumps(chunk))
+
+    for filename in set(manifest) - set(chunks_manifest):
+        path = os.path.join(chunkdir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+    write_json(chunks_manifest, manifest_path)
+    return lazy_chunks
+
+
+COMPRESSION_LEVELS = {'gz': 6, 'zst': 10}
+
+
+@contextlib.contextmanager
+def open_atomic(path, bufsize=1024*1024):
+    """
+    Open a temporary file next to path for writing utf8 text,
+    and replace path with it if the block completes without an error
+
+    If path ends with .gz or .zst, the file is compressed with gzip
+    (without a timestamp, so that the same data compresses to
+    the same bytes) or zstandard (which must be installed).
+    """
+    tmppath = '%s.tmp' % path
+    compression = os.path.splitext(path)[1][1:]
+    try:
+        with io.open(tmppath, 'wb', buffering=bufsize) as _raw:
+            if compression == 'gz':
+                _binary = gzip.GzipFile(
+                    filename='', mode='wb', fileobj=_raw, mtime=0,
+                    compresslevel=COMPRESSION_LEVELS['gz'])
+            elif compression == 'zst':
+                import zstandard
+                _binary = zstandard.ZstdCompressor(
+                    level=COMPRESSION_LEVELS['zst']).stream_writer(_raw)
+            else:
+                _binary = _raw
+            with io.TextIOWrapper(_binary, encoding='utf8',
+                                  newline='') as _file:
+                yield _file
+        os.replace(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
+def set_link_attrs(attrs, new=False):
+    attrs[(None, 'target')] = '_blank'
+    attrs[(None, 'rel')] = 'nofollow noopener'
+    return attrs
+
+
+ALLOWED_TAGS = None
+ALLOWED_ATTRIBUTES = None
+LINKIFYFILTER = None
+CLEANER = None
+
+
+def build_cleaner(always_set=False):
+    """
+    Build the ALLOWED_TAGS, ALLOWED_ATTRIBUTES, LINKIFYFILTER, and CLEANER
+    globals (importing bleach) if they're not already set
+
+    Kwargs:
+        always_set (bool): if True, always rebuild them
+
+    Returns:
+        bleach.sanitizer.Cleaner: CLEANER
+    """
+    global ALLOWED_TAGS, ALLOWED_ATTRIBUTES, LINKIFYFILTER, CLEANER
+    if CLEANER is None or always_set:
+        import bleach
+        ALLOWED_TAGS = list(bleach.sanitizer.ALLOWED_TAGS)
+        ALLOWED_TAGS.extend(['p', 'pre'])
+        ALLOWED_ATTRIBUTES = bleach.sanitizer.ALLOWED_ATTRIBUTES.copy()
+        ALLOWED_ATTRIBUTES['a'] = (
+            list(ALLOWED_ATTRIBUTES['a']) + ['rel'])
+        LINKIFYFILTER = partial(
+                bleach.linkifier.LinkifyFilter,
+                callbacks=[set_link_attrs])
+        CLEANER = bleach.sanitizer.Cleaner(
+                filters=[LINKIFYFILTER],
+                tags=ALLOWED_TAGS,
+                attributes=ALLOWED_ATTRIBUTES)
+    return CLEANER
+
+
+def get_sanitizer_version():
+    """
+    Get a hash of the sanitizer configuration: the bleach version,
+    ALLOWED_TAGS, ALLOWED_ATTRIBUTES, and the linkify callbacks' code
+
+    Returns:
+        str: hex digest
+    """
+    import bleach
+    build_cleaner()
+    callbacks = [
+        [callback.__module__, callback.__name__,
+         hashlib.sha256(callback.__code__.co_code).hexdigest(),
+         repr(callback.__code__.co_consts)]
+        for callback in LINKIFYFILTER.keywords['callbacks']]
+    attributes = dict(
+        (tag, sorted(attrs) if isinstance(attrs, (list, tuple)) else
+            repr(attrs))
+        for tag, attrs in ALLOWED_ATTRIBUTES.items())
+    config = [bleach.__version__, sorted(ALLOWED_TAGS), attributes,
+              callbacks]
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True).encode('utf8')).hexdigest()
+
+
+class CleanMemo(object):
+    """
+    A persistent memo of sanitized HTML in a sqlite database
+
+    Keys are a hash of the sanitizer version (see
+    :func:`get_sanitizer_version`), the operation, and the input text,
+    so entries are invalidated when the sanitizer configuration changes.
+    Writes and access times are buffered until :meth:`flush`,
+    which also evicts the least recently used entries over maxsize.
+    """
+
+    def __init__(self, path, maxsize=100000):
+        """
+        Args:
+            path (str): path to the sqlite database
+
+        Kwargs:
+            maxsize (int): maximum number of entries to keep
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.version = get_sanitizer_version()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS memo'
+            ' (key TEXT PRIMARY KEY, value TEXT, atime REAL)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS memo_atime ON memo (atime)')
+        self.conn.commit()
+        self.pending = {}
+        self.accessed = set()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, op, text):
+        return hashlib.sha256(
+            u'\0'.join((self.version, op, text)).encode('utf8')).hexdigest()
+
+    def get(self, op, text):
+        """
+        Returns:
+            str: the memoized result of op(text), or None
+        """
+        key = self.key(op, text)
+        with self.lock:
+            value = self.pending.get(key)
+            if value is None:
+                row = self.conn.execute(
+                    'SELECT value FROM memo WHERE key = ?',
+                    (key,)).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self.accessed.add(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, op, text, value):
+        with self.lock:
+            self.pending[self.key(op, text)] = value
+
+    def flush(self):
+        """Write buffered entries and evict entries over maxsize"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO memo (key, value, atime)'
+                ' VALUES (?, ?, ?)',
+                ((key, value, now) for key, value in self.pending.items()))
+            self.conn.executemany(
+                'UPDATE memo SET atime = ? WHERE key = ?',
+                ((now, key) for key in self.accessed))
+            self.pending.clear()
+            self.accessed.clear()
+            count = self.conn.execute(
+                'SELECT COUNT(*) FROM memo').fetchone()[0]
+            if count > self.maxsize:
+                self.conn.execute(
+                    'DELETE FROM memo WHERE key IN'
+                    ' (SELECT key FROM memo ORDER BY atime, rowid LIMIT ?)',
+                    (count - self.maxsize,))
+        log.debug(('CleanMemo', self.hits, self.misses))
+
+
+CLEAN_MEMO = None
+
+
+def build_clean_memo(basedir, maxsize=100000, always_set=False):
+    """
+    Build a CleanMemo
+
+    Args:
+        basedir (str): directory to store dlhn-clean.sqlite in
+
+    Kwargs:
+        maxsize (int): maximum number of entries to keep
+        always_set (bool): if True, always set the CLEAN_MEMO global;
+            otherwise only set it if it is None
+    """
+    global CLEAN_MEMO
+    if CLEAN_MEMO is None or always_set:
+        CLEAN_MEMO = CleanMemo(
+            os.path.join(basedir, 'dlhn-clean.sqlite'), maxsize=maxsize)
+
+
+FRAGMENT_MEMO = None
+
+
+def build_fragment_memo(basedir, maxsize=100000, always_set=False):
+    """
+    Build a CleanMemo of rendered HTML fragments
+    (see :func:`make_root_fragment`)
+
+    Args:
+        basedir (str): directory to store dlhn-fragments.sqlite in
+
+    Kwargs:
+        maxsize (int): maximum number of fragments to keep
+        always_set (bool): if True, always set the FRAGMENT_MEMO global;
+            otherwise only set it if it is None
+    """
+    global FRAGMENT_MEMO
+    if FRAGMENT_MEMO is None or always_set:
+        FRAGMENT_MEMO = CleanMemo(
+            os.path.join(basedir, 'dlhn-fragments.sqlite'), maxsize=maxsize)
+
+
+ITEM_FIELDS = ('by', 'dead', 'deleted', 'descendants', 'id', 'kids',
+               'parent', 'parts', 'poll', 'score', 'text', 'time',
+               'time_iso', 'title', 'type', 'url')
+_ITEM_FIELDS = frozenset(ITEM_FIELDS)
+_ITEM_KEYS = {}
+_ITEM_GETTERS = {}
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _kids_array(value):
+    return array.array('q', value) if type(value) is list else value
+
+
+_ITEM_CONVERTERS = {'by': _intern, 'type': _intern, 'kids': _kids_array}
+
+
+class Item(MutableMapping):
+    """
+    A compact HN item which behaves like the item's JSON dict
+
+    The fields of the HN API (ITEM_FIELDS) are stored in slots instead of
+    a dict of per-item key strings; the key order is a tuple shared by
+    all items with the same keys; ``by`` and ``type`` are interned;
+    and ``kids`` is an ``array('q')`` instead of a list of int objects.
+    Other keys are stored in a dict.
+
+    Items are modified through the dict interface (``item['text'] = ...``)
+    and read by the template as attributes (``item.text``). Pass
+    :func:`json_default` to json.dump(s) to serialize them as dicts.
+    """
+
+    __slots__ = ITEM_FIELDS + ('_keys', '_extra')
+
+    def __init__(self, pairs=()):
+        """
+        Kwargs:
+            pairs (dict or iterable): (key, value) pairs
+                (e.g. the item JSON from the HN API)
+        """
+        extra = None
+        if isinstance(pairs, Mapping):
+            pairs = pairs.items()
+        else:
+            pairs = list(pairs)
+        for key, value in pairs:
+            if key in _ITEM_FIELDS:
+                if key in _ITEM_CONVERTERS:
+                    value = _ITEM_CONVERTERS[key](value)
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+        keys = tuple(key for key, value in pairs)
+        self._keys = _ITEM_KEYS.setdefault(keys, keys)
+
+    @classmethod
+    def from_json(cls, obj):
+        """
+        Returns:
+            Item: obj as an Item (or obj if it's None or already an Item)
+        """
+        if obj is None or isinstance(obj, Item):
+            return obj
+        return cls(obj)
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            if key in _ITEM_FIELDS:
+                return getattr(self, key)
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            keys = self._keys + (key,)
+            self._keys = _ITEM_KEYS.setdefault(keys, keys)
+        if key in _ITEM_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        keys = tuple(_key for _key in self._keys if _key != key)
+        self._keys = _ITEM_KEYS.setdefault(keys, keys)
+        if key in _ITEM_FIELDS:
+            delattr(self, key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: the item JSON, in the same key order
+        """
+        obj = {}
+        for key in self._keys:
+            value = self[key]
+            if isinstance(value, array.array):
+                value = value.tolist()
+            obj[key] = value
+        return obj
+
+    def astuple(self):
+        """
+        Returns:
+            tuple: (keys, values) of the item (e.g. to hash)
+        """
+        getter = _ITEM_GETTERS.get(self._keys)
+        if getter is None:
+            if _ITEM_FIELDS.issuperset(self._keys) and self._keys:
+                getter = operator.attrgetter(*self._keys)
+            else:
+                getter = partial(Item._values, keys=self._keys)
+            _ITEM_GETTERS[self._keys] = getter
+        return (self._keys, getter(self))
+
+    def _values(self, keys):
+        return tuple(self[key] for key in keys)
+
+    def __eq__(self, other):
+        if isinstance(other, Item):
+            other = other.to_dict()
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Item(%r)' % (self.to_dict(),)
+
+
+def json_default(obj):
+    """
+    json.dump(s) ``default`` function which serializes Items as dicts
+    """
+    if isinstance(obj, Item):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def json_object_pairs_hook(pairs):
+    """
+    json.load(s) ``object_pairs_hook`` which loads items
+    (objects with 'id' and 'type' keys) as Items and other objects
+    as OrderedDicts
+    """
+    keys = [key for key, value in pairs]
+    if 'id' in keys and 'type' in keys:
+        return Item(pairs)
+    return collections.OrderedDict(pairs)
+
+
+class ItemStore(object):
+    """
+    Items in a sqlite database, as an alternative to index.html.json
+
+    Items are stored as JSON keyed by id, with indexes on ``time``,
+    ``parent``, and ``by``, so that :meth:`get` doesn't require loading
+    every item. The other top-level keys of the data (e.g. 'roots') are
+    stored as JSON in the ``data`` table.
+
+    ItemStore implements the parts of the dict interface that
+    :func:`get_items` and the template use (``get``, ``[]``, ``in``,
+    ``len``, ``items``, ``values``) with str or int keys.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): path to the sqlite database
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS items'
+                ' (id INTEGER PRIMARY KEY, time INTEGER, parent INTEGER,'
+                ' by TEXT, json TEXT)')
+            for column in ('time', 'parent', 'by'):
+                self.conn.execute(
+                    'CREATE INDEX IF NOT EXISTS items_{0}'
+                    ' ON items ({0})'.format(column))
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS data'
+                ' (key TEXT PRIMARY KEY, json TEXT)')
+
+    def _loads(self, json_):
+        return json.loads(json_, object_pairs_hook=json_object_pairs_hook)
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def get(self, key, default=None):
+        try:
+            key = int(key)
+        except (TypeError, ValueError):
+            return default
+        rows = self._query('SELECT json FROM items WHERE id = ?', (key,))
+        if not rows:
+            return default
+        return self._loads(rows[0][0])
+
+    def __getitem__(self, key):
+        item = self.get(key)
+        if item is None:
+            raise KeyError(key)
+        return item
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM items')[0][0]
+
+    def keys(self):
+        return [str(row[0]) for row in
+                self._query('SELECT id FROM items ORDER BY id')]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self, batchsize=1000):
+        """
+        Yields:
+            tuple: (str(id), item) ordered by id, read in batches
+        """
+        lastid = None
+        while True:
+            if lastid is None:
+                rows = self._query(
+                    'SELECT id, json FROM items ORDER BY id LIMIT ?',
+                    (batchsize,))
+            else:
+                rows = self._query(
+                    'SELECT id, json FROM items WHERE id > ?'
+                    ' ORDER BY id LIMIT ?', (lastid, batchsize))
+            if not rows:
+                return
+            for itemid, json_ in rows:
+                yield str(itemid), self._loads(json_)
+            lastid = rows[-1][0]
+
+    def values(self):
+        return (item for key, item in self.items())
+
+    def values_since(self, since):
+        """
+        Returns:
+            list: items with a ``time`` >= since (using the time index)
+        """
+        return [self._loads(row[0]) for row in self._query(
+            'SELECT json FROM items WHERE time >= ?', (since,))]
+
+    def update(self, items, clear=False):
+        """
+        Insert or replace items
+
+        Args:
+            items (dict): items keyed by id
+
+        Kwargs:
+            clear (bool): True to delete all other items
+                in the same transaction
+        """
+        with self.lock, self.conn:
+            if clear:
+                self.conn.execute('DELETE FROM items')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO items (id, time, parent, by, json)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                ((int(key), item.get('time'), item.get('parent'),
+                  item.get('by'), json.dumps(item, default=json_default))
+                 for key, item in items.items()))
+
+    def get_data(self):
+        """
+        Returns:
+            OrderedDict: the stored top-level data (without 'items')
+        """
+        return collections.OrderedDict(
+            (key, self._loads(json_)) for key, json_ in
+            self._query('SELECT key, json FROM data ORDER BY rowid'))
+
+    def set_data(self, data):
+        """
+        Store the top-level data (except 'items')
+
+        Args:
+            data (dict): dict with 'usernames', 'roots', ...
+        """
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM data')
+            self.conn.executemany(
+                'INSERT INTO data (key, json) VALUES (?, ?)',
+                ((key, json.dumps(value)) for key, value in data.items()
+                 if key != 'items'))
+
+    def close(self):
+        self.conn.close()
+
+
+def get_cached_since(cache, since):
+    """
+    Returns:
+        list: items in cache (a dict or an ItemStore) with a ``time``
+            >= since
+    """
+    if isinstance(cache, ItemStore):
+        return cache.values_since(since)
+    return [_obj for _obj in cache.values() if _obj['time'] >= since]
+
+
+def cleanup_html(html):
+    if CLEAN_MEMO is not None:
+        cleaned = CLEAN_MEMO.get('cleanup_html', html)
+        if cleaned is not None:
+            METRICS.incr('sanitize_memo_hits')
+            return cleaned
+    with METRICS.phase('sanitize'):
+        _html = unescape(html)
+        cleaned = build_cleaner().clean(_html)
+    METRICS.incr('sanitized')
+    if CLEAN_MEMO is not None:
+        CLEAN_MEMO.set('cleanup_html', html, cleaned)
+    return cleaned
+
+
+def get_response(url, retries=3, **kwargs):
+    """
+    GET ``url`` with REQUESTS, retrying responses with a status code
+    in RETRY_STATUS_CODES
+    (the rate limit hook has already backed off before they return)
 
-    Raises:
-        Exception: ...
+    Kwargs:
+        kwargs: passed to REQUESTS.get (e.g. force_refresh=True)
     """
-    build_requests_session(os.path.dirname(output))
+    log.info(('GET', url))
+    for attempt in range(retries):
+        resp = REQUESTS.get(url, **kwargs)
+        if getattr(resp, 'from_cache', False):
+            METRICS.incr('http_from_cache')
+        else:
+            METRICS.incr('http_get')
+            METRICS.incr('http_bytes', len(getattr(resp, 'content', b'')))
+        if getattr(resp, 'status_code', 200) not in RETRY_STATUS_CODES:
+            break
+        METRICS.incr('http_retries')
+        log.warning(('RETRY', resp.status_code, url))
+    return resp
 
-    output_json = '%s.json' % output
-    datasource = inputjson if inputjson else 'HN API'
-    log.info(
-        "Reading data from %r%s into %r%s and then templating to %r",
-        datasource,
-        ((' for user %r' % username) if username else ''),
-        output_json,
-        (', upgrading the JSON,' if inputjson_upgrade and inputjson else ''),
-        output)
 
+def get_json(url, retries=3, **kwargs):
+    """
+    GET ``url`` with :func:`get_response` and return the parsed JSON
+    """
+    return get_response(url, retries=retries, **kwargs).json()
 
-    cache = None
-    if os.path.exists(output_json):
-        with codecs.open(output_json, 'r', encoding='utf8') as _file:
-            _data = json.load(
-                _file,
-                object_pairs_hook=collections.OrderedDict)
-            cache = _data.get('items')
-            log.info(u'Reading cache from %r (%d)' %
-                     (output_json, len(cache)))
 
-    if inputjson is None:
-        items, roots = get_items(username, cache=cache)
-        data = collections.OrderedDict()
-        data['usernames'] = [username]
-        data['items'] = items
-        data['roots'] = roots
-    else:
-        log.info("Loading JSON from %r" % inputjson)
-        with open(inputjson, 'r') as _inputjsonfile:
-            data = json.load(_inputjsonfile,
-                    object_pairs_hook=collections.OrderedDict)
+def get_item_json(objkey, cache=None, cache_before=None, freeze_before=None):
+    """
+    Get the JSON for one item from ``cache`` or from the HN API
 
-        required_attrs = ('usernames', 'items', 'roots')
-        missing_attrs = []
-        for attr in required_attrs:
-            if attr not in data:
-                missing_attrs.append(attr)
-        if missing_attrs:
-            raise ValueError(
-                'inputjson does not have attrs: %r' % missing_attrs)
+    Items older than ``cache_before`` are frozen in the requests_cache
+    layer (see :class:`FrozenItems`); newer items that requests_cache
+    returned from its cache are requested again, so only items that can
+    still change are revalidated.
 
-        if inputjson_upgrade:
-            log.info("Upgrading JSON from %r" % inputjson)
-            for itemid, item in data['items'].items():
-                # item = data['items'].get(str(itemid))
-                if item is None:
-                    log.error('itemid %r is not in data["items"]'
-                            % itemid)
-                else:
-                    if item.get('type') == 'comment':
-                        if 'text' not in item:
-                            if item.get('deleted') != True:
-                                log.error(
-                                    ('itemid %r does not have a "text" attr'
-                                        % itemid, item))
-                        else:
-                            try:
-                                # log.debug(('upgrading item', item))
-                                item['text'] = CLEANER.clean(item['text'])
-                            except ValueError as e:
-                                log.exception(e)
-                                log.error(('item[text]', item['text']))
-
-    if inputjson is None or inputjson_upgrade is True:
-        log.info("Writing JSON to %r" % output_json)
-        with codecs.open(output_json, 'w', encoding='utf8') as _file:
-            json.dump(data, _file, indent=2)
+    Args:
+        objkey (int): HN item id
 
-    # read JSON from disk
-    log.info("Loading JSON from %r" % inputjson)
-    with open(output_json, 'r') as _outputjsonfile:
-        data = json.load(_outputjsonfile,
-                object_pairs_hook=collections.OrderedDict)
+    Kwargs:
+        cache (dict): items keyed by str(id) (e.g. index.html.json['items'])
+        cache_before (float): only use cached items with a ``time``
+            older than this timestamp
+        freeze_before (float): freeze fetched items with a ``time``
+            older than this timestamp and revalidate newer ones
+            (default: cache_before)
 
-    log.info("Generating HTML with template")
-    html = TEMPLATE.render(str=str, **data)
+    Returns:
+        dict: item JSON (or None if the API returned null)
+    """
+    if cache is not None:
+        _obj = cache.get(str(objkey))
+        if _obj is not None:
+            if _obj['time'] < cache_before:
+                log.info(('CACHE', objkey))
+                METRICS.incr('item_cache_hits')
+                return _obj
 
-    log.info("Writing HTML to %r" % output)
-    with codecs.open(output, 'w', encoding='utf8') as _file:
-        _file.write(html)
-    return html
+    url = (
+        '{}/item/{}.json'
+        .format(HN_API_URL, objkey))
+    resp = get_response(url)
+    objjson = resp.json()
+    if freeze_before is None:
+        freeze_before = cache_before
+    if objjson and freeze_before is not None:
+        if objjson['time'] < freeze_before:
+            frozen = getattr(REQUESTS, 'frozen', None)
+            if frozen is not None:
+                frozen.freeze(objkey, resp, itemtime=objjson['time'])
+        elif getattr(resp, 'from_cache', False):
+            log.info(('REVALIDATE', objkey))
+            objjson = get_json(url, force_refresh=True)
+    return objjson
+
+
+def get_user(username):
+    """
+    Get a user's profile (including the ``submitted`` list of item ids)
+    from the HN API
+    """
+    url = (
+        '{}/user/{}.json?nonce={}'
+        .format(HN_API_URL, username, datetime.datetime.now().isoformat()))
+    return get_json(url)
 
 
-ALLOWED_TAGS = list(bleach.sanitizer.ALLOWED_TAGS)
-ALLOWED_TAGS.extend(['p', 'pre'])
-ALLOWED_ATTRIBUTES = bleach.sanitizer.ALLOWED_ATTRIBUTES.copy()
-ALLOWED_ATTRIBUTES['a'].append('rel')
+def get_expanded_ids(cache, submitted):
+    """
+    Get the ids of cached items whose kids were crawled: the ``submitted``
+    ids and their cached descendants
 
+    Args:
+        cache (dict): items keyed by str(id)
+        submitted (list): item ids submitted by the user
 
-def set_link_attrs(attrs, new=False):
-    attrs[(None, 'target')] = '_blank'
-    attrs[(None, 'rel')] = 'nofollow noopener'
-    return attrs
+    Returns:
+        set: item ids
+    """
+    expanded = set()
+    queue = collections.deque(submitted)
+    while len(queue):
+        objkey = queue.popleft()
+        if objkey in expanded:
+            continue
+        _obj = cache.get(str(objkey))
+        if _obj is None:
+            continue
+        expanded.add(objkey)
+        queue.extend(_obj.get('kids', []))
+    return expanded
 
 
-LINKIFYFILTER = partial(
-        bleach.linkifier.LinkifyFilter,
-        callbacks=[set_link_attrs])
-CLEANER = bleach.sanitizer.Cleaner(
-        filters=[LINKIFYFILTER],
-        tags=ALLOWED_TAGS,
-        attributes=ALLOWED_ATTRIBUTES)
+class CrawlJournal(object):
+    """
+    An append-only journal of the items fetched (and cleaned) by a crawl,
+    one ``[id, item]`` JSON line per item, so that an interrupted crawl
+    can be resumed without fetching and sanitizing them again
+
+    The queue isn't journaled: :func:`get_items` visits items in the same
+    order given the same items, so passing the journaled items to it as
+    ``fetched`` (see :meth:`load`) rebuilds the queue, items, and roots
+    without requests. Lines are flushed every flush_every items.
+    """
 
+    def __init__(self, path, flush_every=100):
+        """
+        Args:
+            path (str): path to the journal (e.g. index.html.journal)
+
+        Kwargs:
+            flush_every (int): flush the journal after this many items
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = 0
+        self._file = None
+
+    def load(self):
+        """
+        Read the journal, dropping a partially written last line
+
+        Returns:
+            dict: {id: :class:`Item` or None} in the order fetched
+        """
+        items = collections.OrderedDict()
+        if not os.path.exists(self.path):
+            return items
+        end = 0
+        with open(self.path, 'rb') as _file:
+            for line in _file:
+                try:
+                    objkey, objjson = json.loads(line.decode('utf8'))
+                except ValueError:
+                    log.warning(('JOURNAL', 'truncated', self.path, end))
+                    break
+                items[objkey] = Item.from_json(objjson)
+                end += len(line)
+        if end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as _file:
+                _file.truncate(end)
+        return items
+
+    def open(self, resume=False):
+        """
+        Kwargs:
+            resume (bool): True to append to the journal;
+                False to start a new journal
+        """
+        self._file = open(self.path, 'ab' if resume else 'wb')
+        self.pending = 0
+
+    def append(self, objkey, objjson):
+        self._file.write(json.dumps(
+            [objkey, objjson], default=json_default).encode('utf8') + b'\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+        self.pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Close and remove the journal (once the crawl has been saved)"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_items(username, cache=None, jobs=1,
+              user=None, incremental=False, submitted=None,
+              cache_clean=False, fetched=None, journal=None,
+              max_depth=None, max_kids=None, max_items=None,
+              max_seconds=None, cache_before=None):
+    """
+    Get a user's items and the items above and below them
 
-def cleanup_html(html):
-    _html = unescape(html)
-    return CLEANER.clean(_html)
+    Args:
+        username (str): hackernews username
 
+    Kwargs:
+        cache (dict): items keyed by str(id) (e.g. index.html.json['items'])
+        jobs (int): number of threads to fetch items with.
+            With jobs > 1, a thread pool prefetches the queued items
+            (a window at a time) and, as each fetch completes, that
+            item's parent and kids within the scope limits. Items are
+            then visited in the same order as with jobs=1, so the
+            output is the same.
+        user (dict): the user's profile JSON (default: fetch it)
+        incremental (bool): if True, only crawl new submissions and
+            cached items that are newer than 14 days (and may still change),
+            and skip cached items older than 14 days; the returned items
+            and roots must then be merged into the cache
+            (see :func:`merge_items`)
+        submitted (list): the ``submitted`` ids from the previous crawl
+            (required for ``incremental``)
+        cache_clean (bool): True if the cached items were sanitized
+            by the current sanitizer and don't need to be cleaned again
+            (see :func:`is_data_current`)
+        fetched (dict): items that were already fetched (and cleaned)
+            keyed by id, which is shared by the crawls of several users
+            so that each item is only fetched once; fetched items are
+            added to it
+        journal (CrawlJournal): append fetched items to this journal
+            (see :class:`CrawlJournal`)
+        max_depth (int): only crawl replies this many levels below
+            the user's items (0 for the user's items and their ancestors)
+        max_kids (int): only crawl the first max_kids kids of each item
+        max_items (int): stop crawling replies once this many items
+            have been crawled
+        max_seconds (float): stop crawling replies after this many seconds
+        cache_before (float): use the cached items with a ``time`` older
+            than this timestamp instead of fetching them
+            (default: 14 days ago, when HN items can no longer change)
+
+        The user's items and their ancestors are always crawled.
+        Items whose kids weren't all crawled because of max_depth,
+        max_kids, max_items, or max_seconds get a ``truncated`` count
+        of the kids that weren't crawled.
 
-def get_items(username, cache=None):
-    url = (
-        'https://hacker-news.firebaseio.com/v0/user/{}.json?nonce={}'
-        .format(username, datetime.datetime.now().isoformat()))
-    log.info(('GET', url))
-    resp = REQUESTS.get(url)
-    json_ = resp.json()
+    Returns:
+        tuple: (items, roots); items is an OrderedDict of :class:`Item`
+            sorted by id
+    """
+    if user is None:
+        user = get_user(username)
     items = collections.OrderedDict()
     roots = []
-    # stack-based ~depth-first search (visitor pattern)
-    queue = collections.deque(json_.get('submitted'))
     daysago_14 = time.mktime(
         (datetime.datetime.utcnow()-datetime.timedelta(14))
         .timetuple())
-    while len(queue):
-        objkey, objtype = queue.popleft(), None
-        if isinstance(objkey, tuple):
-            objkey, objtype = objkey
-        if objkey in items:
-            continue
+    # stack-based ~depth-first search (visitor pattern)
+    queue = collections.deque(user.get('submitted') or [])
+    # with incremental, cached items older than 14 days are not revisited
+    skip_frozen = False
 
-        objjson = None
-        if cache is not None:
-            _obj = cache.get(str(objkey))
-            if _obj is not None:
-                if _obj['time'] < daysago_14:
-                    objjson = _obj
-                    log.info(('CACHE', objkey))
-
-        if objjson is None:
-            url = (
-                'https://hacker-news.firebaseio.com/v0/item/{}.json'
-                .format(objkey))
-            log.info(('GET', url))
-            objresp = REQUESTS.get(url)
-            objjson = objresp.json()
-
-        if objjson:
-            if 'text' in objjson:
-                objjson['text'] = cleanup_html(objjson['text'])
-            objdate = datetime.datetime.fromtimestamp(objjson['time'])
-            objjson[u'time_iso'] = objdate.strftime("%F %T%Z")
-            if objtype != 'parent':
-                queue.extendleft(objjson.get('kids', []))
-            parent = objjson.get('parent')
-            if parent is None:
-                roots.append(objjson['id'])
+    if incremental:
+        if cache is None or submitted is None:
+            log.info('No previous crawl to update; crawling everything')
+        else:
+            seen = set(submitted)
+            queue = collections.deque(
+                objkey for objkey in queue if objkey not in seen)
+            expanded = get_expanded_ids(cache, submitted)
+            mutable = sorted(
+                get_cached_since(cache, daysago_14),
+                key=lambda _obj: _obj['time'], reverse=True)
+            for _obj in mutable:
+                if _obj['id'] in expanded:
+                    queue.append(_obj['id'])
+                else:
+                    queue.append((_obj['id'], 'parent'))
+            log.info('Updating %d new submissions and %d items newer'
+                     ' than 14 days', len(queue) - len(mutable),
+                     len(mutable))
+            skip_frozen = True
+
+    def is_cached(objkey):
+        # get_item_json returns cached items older than 14 days
+        if cache is None:
+            return False
+        _obj = cache.get(str(objkey))
+        return _obj is not None and _obj['time'] < cache_before
+
+    def is_frozen(objkey):
+        return skip_frozen and is_cached(objkey)
+
+    if cache_before is None:
+        cache_before = daysago_14
+    fetch = partial(get_item_json, cache=cache, cache_before=cache_before,
+                    freeze_before=daysago_14)
+
+    # reply levels below the user's nearest item, by id
+    depths = {}
+    truncated = set()
+    start = time.time()
+
+    def get_kids(objkey, objjson):
+        # the kids to crawl within max_depth, max_kids, and the budget
+        kids = list(objjson.get('kids', []))
+        depth = 0 if objjson.get('by') == username else depths.get(objkey, 0)
+        if ((max_depth is not None and depth >= max_depth)
+                or (max_items is not None and len(items) >= max_items)
+                or (max_seconds is not None
+                    and time.time() - start >= max_seconds)):
+            scoped_kids = []
+        else:
+            scoped_kids = kids[:max_kids]
+        for kid in scoped_kids:
+            depths[kid] = depth + 1
+        if len(scoped_kids) < len(kids):
+            truncated.add(objkey)
+        elif 'truncated' in objjson:
+            del objjson['truncated']
+        return scoped_kids
+
+    share_fetched = fetched is not None
+    if fetched is None:
+        fetched = {}
+    pool = None
+    futures = {}
+    # ids submitted to the pool (futures are popped when they're visited)
+    requested = set()
+    lock = threading.Lock()
+    state = dict(in_flight=0, stopped=False)
+    window = jobs * 4
+
+    def prefetch(objkeys, expand=True, depth=0):
+        for objkey in objkeys:
+            _expand = expand
+            if isinstance(objkey, tuple):
+                objkey, _expand = objkey[0], objkey[1] != 'parent'
+            if (objkey in items or objkey in fetched
+                    or is_frozen(objkey)):
+                continue
+            with lock:
+                if state['stopped'] or objkey in requested:
+                    continue
+                requested.add(objkey)
+                state['in_flight'] += 1
+                futures[objkey] = pool.submit(
+                    fetch_and_prefetch, objkey, _expand, depth)
+
+    def fetch_and_prefetch(objkey, expand, depth):
+        # fetch an item and then prefetch its parent and, unless it's only
+        # an ancestor, its kids within the scope limits, so that the pool
+        # doesn't wait for the visitor
+        try:
+            objjson = fetch(objkey)
+            if objjson:
+                if expand:
+                    if objjson.get('by') == username:
+                        depth = 0
+                    if ((max_depth is None or depth < max_depth)
+                            and (max_items is None
+                                 or len(requested) < max_items)
+                            and (max_seconds is None
+                                 or time.time() - start < max_seconds)):
+                        prefetch(objjson.get('kids', [])[:max_kids],
+                                 depth=depth + 1)
+                parent = objjson.get('parent')
+                if parent is not None:
+                    prefetch((parent,), expand=False)
+            return objjson
+        finally:
+            with lock:
+                state['in_flight'] -= 1
+            prefetch_queued()
+
+    # the queued ids are prefetched a window at a time so that the
+    # parents and kids of fetched items don't wait behind all of them.
+    # Their kids aren't prefetched: a queued item may be visited first as
+    # the parent of a newer item, and then its kids aren't crawled. The
+    # kids of visited items are prefetched (and expanded) instead.
+    queued = iter(list(queue))
+
+    def prefetch_queued():
+        while True:
+            with lock:
+                if state['in_flight'] >= window:
+                    break
+                objkey = next(queued, None)
+            if objkey is None:
+                break
+            prefetch((objkey,), expand=False)
+
+    if jobs > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    try:
+        while len(queue):
+            objkey, objtype = queue.popleft(), None
+            if isinstance(objkey, tuple):
+                objkey, objtype = objkey
+            if objkey in items or is_frozen(objkey):
+                continue
+
+            if objkey in fetched:
+                objjson = fetched[objkey]
+                METRICS.incr('item_shared_hits')
             else:
-                queue.appendleft((parent, 'parent'))
-            items[objkey] = objjson
+                if pool is not None:
+                    prefetch_queued()
+                    prefetch(((objkey, objtype),))
+                with lock:
+                    future = futures.pop(objkey, None)
+                if future is None:
+                    objjson = fetch(objkey)
+                else:
+                    objjson = future.result()
+                if objjson and not (cache_clean and is_cached(objkey)):
+                    if 'text' in objjson:
+                        objjson['text'] = cleanup_html(objjson['text'])
+                    objdate = datetime.datetime.fromtimestamp(
+                        objjson['time'])
+                    objjson[u'time_iso'] = objdate.strftime("%F %T%Z")
+                objjson = Item.from_json(objjson)
+                if share_fetched:
+                    fetched[objkey] = objjson
+                if journal is not None and not is_cached(objkey):
+                    journal.append(objkey, objjson)
+
+            if objjson:
+                if objtype != 'parent':
+                    kids = get_kids(objkey, objjson)
+                    queue.extendleft(kids)
+                    if pool is not None:
+                        for kid in kids:
+                            prefetch((kid,), depth=depths[kid])
+                parent = objjson.get('parent')
+                if parent is None:
+                    roots.append(objjson['id'])
+                else:
+                    queue.appendleft((parent, 'parent'))
+                    if pool is not None:
+                        prefetch((parent,), expand=False)
+                items[objkey] = objjson
+        METRICS.peak('items_peak', len(items))
+        for objkey in truncated:
+            objjson = items[objkey]
+            missing = sum(
+                1 for kid in objjson.get('kids', []) if kid not in items)
+            if missing:
+                objjson['truncated'] = missing
+                METRICS.incr('items_truncated')
+            elif 'truncated' in objjson:
+                del objjson['truncated']
+    finally:
+        if pool is not None:
+            with lock:
+                state['stopped'] = True
+                for future in futures.values():
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+    return sort_items(items), roots
+
+
+def sort_items(items):
+    """
+    Sort an OrderedDict of items by key in place
+    (instead of building a sorted copy of a large archive)
+
+    Returns:
+        OrderedDict: items
+    """
+    for key in sorted(items):
+        items.move_to_end(key)
+    return items
+
+
+def merge_items(cache, cache_roots, items, roots):
+    """
+    Merge the items and roots from an incremental :func:`get_items`
+    into the previous crawl's items and roots
+
+    Args:
+        cache (dict): previous items keyed by str(id)
+        cache_roots (list): previous root ids
+        items (dict): new items keyed by id
+        roots (list): new root ids
+
+    Returns:
+        tuple: (items_sorted, roots)
+    """
+    merged = dict((int(key), item) for key, item in cache.items())
+    merged.update(items)
+    link_kids(items, merged.get)
     items_sorted = collections.OrderedDict((
-        (key, items.get(key)) for key in sorted(items)
+        (key, merged[key]) for key in sorted(merged)
     ))
-    return items_sorted, roots
+    return items_sorted, merge_roots(cache_roots, roots)
+
+
+def link_kids(items, get_item):
+    """
+    Add new items to their parents' kids
+
+    Frozen parents are not refetched by an incremental crawl,
+    so their kids may be out of date.
+
+    Args:
+        items (dict): new items keyed by id
+        get_item (callable): returns the (merged) item for an id or None
+
+    Returns:
+        dict: parents whose kids were modified, keyed by id
+    """
+    parents = {}
+    for key, item in items.items():
+        parentid = item.get('parent')
+        parent = get_item(parentid) if parentid is not None else None
+        if parent is not None and key not in parent.get('kids', []):
+            parent.setdefault('kids', []).append(key)
+            parents[parentid] = parent
+    return parents
+
+
+def merge_roots(cache_roots, roots):
+    """
+    Returns:
+        list: roots followed by the cache_roots that aren't in roots
+    """
+    roots_set = set(roots)
+    roots = list(roots)
+    roots.extend(key for key in cache_roots if key not in roots_set)
+    return roots
+
 
+def get_submitted_roots(get_item, submitted):
+    """
+    Get the roots of a user's items in the order that :func:`get_items`
+    finds them: by the user's newest item under each root
+
+    Args:
+        get_item (callable): returns the (merged) item for an id or None
+        submitted (list): the user's submitted ids, newest first
 
-TEMPLATE = jinja2.Template("""
+    Returns:
+        list: root ids
+    """
+    roots = []
+    root_ids = {}
+    for objkey in submitted:
+        chain = []
+        rootid = None
+        while objkey is not None:
+            if objkey in root_ids:
+                rootid = root_ids[objkey]
+                break
+            item = get_item(objkey)
+            if not item:
+                break
+            chain.append(objkey)
+            if item.get('parent') is None:
+                rootid = objkey
+                roots.append(rootid)
+                break
+            objkey = item['parent']
+        for key in chain:
+            root_ids[key] = rootid
+    return roots
+
+
+TEMPLATE_NAME = 'index.html'
+TEMPLATE_SOURCE = """{%- macro render_items(roots) -%}
+  {% for itemid in roots recursive -%}
+  {% set item=items.get(str(itemid)) -%}
+  {% if item != None -%}
+  {% set itemcssid="{}-{}".format(item.type, item.id) -%}
+  {% set fromme=(item.by in usernames) -%}
+  {% set collapsed=(not fromme and item.parent) %}
+  {%- if lazy_chunks is defined and item.id in lazy_chunks %}
+  <div class="item card {{ item.type }} lazy" id="{{ itemcssid }}" data-chunk="{{ lazy_chunks[item.id] }}">
+    <div class="card-block">
+      <a class="collapser" href="#{{ itemcssid }}-collapse" onclick="toggleDownward(this);event.preventDefault()">[+]</a>
+    </div>
+  </div>
+  {%- else %}
+  <div class="item card {{ item.type }}" id="{{ itemcssid }}">
+    <div class="card-block">
+      <a class="collapser" href="#{{ itemcssid }}-collapse" onclick="toggleDownward(this);event.preventDefault()">
+      {%- if not fromme %}{% if collapsed %}[+]{% else %}[-]{% endif %}{% endif %}</a>
+      <div class="{% if not fromme %}collapsable{% endif %}{% if collapsed %} collapsed{% endif %}" id="{{ itemcssid }}-collapse">
+        <h4 class="card-title{% if fromme %} bold{% endif %}">
+          {%- if item.title -%}<a href="#{{ itemcssid }}">{{ item.title }}</a>{% endif -%}
+        </h4>
+        <div class="card-subtitle text-muted">
+          <a href="https://news.ycombinator.com/user?id={{ item.by }}" target="_blank" rel="nofollow noopener">{{ item.by }}</a> |
+          <a href="https://news.ycombinator.com/item?id={{ item.id }}" target="_blank" rel="nofollow noopener"
+          {% if not item.title %}id="{{ itemcssid }}"{% endif %}
+          >{{ item.time_iso }}</a>
+          {%- if item.score %} | {{ item.score }} {% endif %} | <a href="#{{ itemcssid }}">#</a> | <a href="#" class="toplink">^</a>
+        </div>
+        {% if item.url -%}
+        <div class="card-subtitle text-muted">
+            <span><a href="{{ item.url }}" target="_blank" rel="nofollow noopener">{{ item.url }}</a></span>
+        </div>
+        {% endif -%}
+        {%- if item.text %}
+        <p class="card-text">{% autoescape false %}{{ item.text }}{% endautoescape %}</p>
+        {%- endif -%}
+        {%- if item.deleted %}<p class="card-text">[deleted]</p>{% endif -%}
+        {%- if not fromme and item.parent %}</div>{% endif -%}
+        {% if item.kids -%}
+        <div class="kids">
+          {{ loop(item.kids) }}
+        </div>
+        {%- endif -%}
+        {%- if item.truncated %}
+        <div class="truncated card-subtitle text-muted">
+          <a href="https://news.ycombinator.com/item?id={{ item.id }}" target="_blank" rel="nofollow noopener">{{ item.truncated }} more {% if item.truncated == 1 %}reply{% else %}replies{% endif %} on HN</a>
+        </div>
+        {%- endif -%}
+      </div>
+    </div>
+  </div>
+  {%- endif %}{# lazy_chunks #}
+  {%- endif -%}{# item != None #}
+  {%- endfor -%}
+{%- endmacro %}
 <!doctype html>
 <html>
 <head>
@@ -383,6 +3139,59 @@ TEMPLATE = jinja2.Template("""
           }
       }
   </script>
+  {%- if lazy_chunks is defined %}
+  <script>
+      // collapsed subtrees without the user's items are .lazy placeholders
+      // whose items are loaded from chunk scripts (dlhnChunk({id: html}))
+      var lazyItems = {};
+      function dlhnChunk(items) {
+          $.extend(lazyItems, items);
+      }
+      function loadLazy(item, callback) {
+          var lazy = item.find('.lazy').addBack('.lazy');
+          var srcs = [];
+          lazy.each(function () {
+              var src = $(this).data('chunk');
+              if (srcs.indexOf(src) < 0) {
+                  srcs.push(src);
+              }
+          });
+          var pending = srcs.length;
+          if (!pending) {
+              callback();
+              return;
+          }
+          $.each(srcs, function (i, src) {
+              var script = document.createElement('script');
+              script.onload = script.onerror = function () {
+                  if (--pending) {
+                      return;
+                  }
+                  lazy.each(function () {
+                      if (this.id in lazyItems) {
+                          $(this).replaceWith(lazyItems[this.id]);
+                      }
+                  });
+                  callback();
+              };
+              script.src = src;
+              document.head.appendChild(script);
+          });
+      }
+      var toggleLoaded = toggleDownward;
+      toggleDownward = function (elem) {
+          if ($(elem).text() !== '[+]') {
+              toggleLoaded(elem);
+              return;
+          }
+          var itemid = $(elem).closest(".item").attr('id');
+          loadLazy($(elem).closest(".item"), function () {
+              toggleLoaded($(document.getElementById(itemid))
+                           .find('a.collapser').first());
+          });
+      };
+  </script>
+  {%- endif %}
 </head>
 <body>
   <nav class="navbar navbar-expand-md navbar-dark bg-dark mb-4" role="navigation">
@@ -395,7 +3204,7 @@ TEMPLATE = jinja2.Template("""
         <li class="nav-item">
           <a class="nav-link" href="#contents">Contents</a>
         </li>
-        <li class="nav-item">
+        <li class="nav-item{% if show_items is defined and not show_items %} d-none{% endif %}">
           <a class="nav-link" href="#items">Items</a>
         </li>
       </ul>
@@ -420,7 +3229,7 @@ TEMPLATE = jinja2.Template("""
     {% set fromme=(item.by in usernames) -%}
     <tr scope="row" {% if fromme %} class="bold"{% endif %}>
         <td>{{ item.time_iso }}</td>
-        <td><a href="#{{itemcssid}}">{{ item.title }}</a></td>
+        <td><a href="{% if root_hrefs is defined %}{{ root_hrefs[itemid] }}{% endif %}#{{itemcssid}}">{{ item.title }}</a></td>
         <td><a href="https://news.ycombinator.com/user?id={{item.by}}">{{ item.by }}</a></td>
         <td>{{ item.score }}</td>
     </tr>
@@ -428,69 +3237,123 @@ TEMPLATE = jinja2.Template("""
     </tbody>
   </table>
 
+  {% if show_items is not defined or show_items -%}
   <h3><a id="items" href="#items">Items</a><a href="#" class="toplink">^</a></h3>
-  {% for itemid in roots recursive -%}
-  {% set item=items.get(str(itemid)) -%}
-  {% if item != None -%}
-  {% set itemcssid="{}-{}".format(item.type, item.id) -%}
-  {% set fromme=(item.by in usernames) -%}
-  {% set collapsed=(not fromme and item.parent) %}
-  <div class="item card {{ item.type }}" id="{{ itemcssid }}">
-    <div class="card-block">
-      <a class="collapser" href="#{{ itemcssid }}-collapse" onclick="toggleDownward(this);event.preventDefault()">
-      {%- if not fromme %}{% if collapsed %}[+]{% else %}[-]{% endif %}{% endif %}</a>
-      <div class="{% if not fromme %}collapsable{% endif %}{% if collapsed %} collapsed{% endif %}" id="{{ itemcssid }}-collapse">
-        <h4 class="card-title{% if fromme %} bold{% endif %}">
-          {%- if item.title -%}<a href="#{{ itemcssid }}">{{ item.title }}</a>{% endif -%}
-        </h4>
-        <div class="card-subtitle text-muted">
-          <a href="https://news.ycombinator.com/user?id={{ item.by }}" target="_blank" rel="nofollow noopener">{{ item.by }}</a> |
-          <a href="https://news.ycombinator.com/item?id={{ item.id }}" target="_blank" rel="nofollow noopener"
-          {% if not item.title %}id="{{ itemcssid }}"{% endif %}
-          >{{ item.time_iso }}</a>
-          {%- if item.score %} | {{ item.score }} {% endif %} | <a href="#{{ itemcssid }}">#</a> | <a href="#" class="toplink">^</a>
-        </div>
-        {% if item.url -%}
-        <div class="card-subtitle text-muted">
-            <span><a href="{{ item.url }}" target="_blank" rel="nofollow noopener">{{ item.url }}</a></span>
-        </div>
-        {% endif -%}
-        {%- if item.text %}
-        <p class="card-text">{% autoescape false %}{{ item.text }}{% endautoescape %}</p>
-        {%- endif -%}
-        {%- if item.deleted %}<p class="card-text">[deleted]</p>{% endif -%}
-        {%- if not fromme and item.parent %}</div>{% endif -%}
-        {% if item.kids -%}
-        <div class="kids">
-          {{ loop(item.kids) }}
-        </div>
-        {%- endif -%}
-      </div>
-    </div>
-  </div>
-  {%- endif -%}{# item != None #}
-  {%- endfor -%}
+  {% if root_fragment is defined -%}
+  {%- for itemid in roots %}{{ root_fragment(itemid) }}{% endfor -%}
+  {%- else -%}
+  {{- render_items(roots) -}}
+  {%- endif -%}
+  {%- endif -%}
   </main>
 </body>
 </html>
-""")
+"""
+
+
+TEMPLATE_ENVIRONMENTS = {}
+
+
+def get_template_environment(template_dir=None, bytecode_cache_dir=None):
+    """
+    Get a jinja2 Environment which loads templates from template_dir
+    (if specified) and then the built-in TEMPLATE_SOURCE, and caches
+    compiled templates in memory and as bytecode on disk
+
+    Environments are reused, so templates are only compiled once
+    per process (and only once per TEMPLATE_SOURCE / template file change
+    across processes, with the bytecode cache).
+
+    Kwargs:
+        template_dir (str): directory to load templates from first
+        bytecode_cache_dir (str): directory to store compiled templates in
+            (default: jinja2's default, in the system temp directory)
+
+    Returns:
+        jinja2.Environment: template environment
+    """
+    envkey = (template_dir, bytecode_cache_dir)
+    env = TEMPLATE_ENVIRONMENTS.get(envkey)
+    if env is None:
+        import jinja2
+        loaders = []
+        if template_dir is not None:
+            loaders.append(jinja2.FileSystemLoader(template_dir))
+        loaders.append(jinja2.DictLoader({TEMPLATE_NAME: TEMPLATE_SOURCE}))
+        env = jinja2.Environment(
+            loader=jinja2.ChoiceLoader(loaders),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(
+                bytecode_cache_dir))
+        TEMPLATE_ENVIRONMENTS[envkey] = env
+    return env
+
+
+def get_template_version(template=None):
+    """
+    Get a hash of __version__ and the template source
+
+    Kwargs:
+        template (str): path to a template file (see :func:`get_template`)
+
+    Returns:
+        str: hex digest
+    """
+    if template is None:
+        source = TEMPLATE_SOURCE
+    else:
+        with codecs.open(template, 'r', encoding='utf8') as _file:
+            source = _file.read()
+    return hashlib.sha256(
+        (__version__ + source).encode('utf8')).hexdigest()
+
 
+def get_template(template=None, bytecode_cache_dir=None):
+    """
+    Get a compiled template
+
+    Kwargs:
+        template (str): path to a template file to use instead of
+            the built-in template
+        bytecode_cache_dir (str): see :func:`get_template_environment`
 
-import unittest
+    Returns:
+        jinja2.Template: template
+    """
+    if template is None:
+        env = get_template_environment(
+            bytecode_cache_dir=bytecode_cache_dir)
+        return env.get_template(TEMPLATE_NAME)
+    template = os.path.abspath(template)
+    env = get_template_environment(
+        template_dir=os.path.dirname(template),
+        bytecode_cache_dir=bytecode_cache_dir)
+    return env.get_template(os.path.basename(template))
+
+
+def get_test_case():
+    """
+    Returns:
+        unittest.TestCase: the Test_dlhn test case class for ``dlhn -t``
+            (defined here so that importing dlhn doesn't import
+            unittest and bs4)
+    """
+    import unittest
 
+    class Test_dlhn(unittest.TestCase):
 
-class Test_dlhn(unittest.TestCase):
+        def test_dlhn(self):
+            import bs4
+            destfile = os.path.join('.', 'test.html')
+            output = dlhn('dlhntestuser', output=destfile)
+            assert output
+            with codecs.open(destfile, 'r', encoding='utf8') as file_:
+                print(bs4.BeautifulSoup(file_, features='html.parser')
+                        .find('main').prettify())
 
-    def test_dlhn(self):
-        destfile = os.path.join('.', 'test.html')
-        output = dlhn('dlhntestuser', output=destfile)
-        assert output
-        with codecs.open(destfile, 'r', encoding='utf8') as file_:
-            print(bs4.BeautifulSoup(file_, features='html.parser')
-                    .find('main').prettify())
+            import subprocess
+            subprocess.check_call(("python", "-m", "webbrowser", destfile))
 
-        import subprocess
-        subprocess.check_call(("python", "-m", "webbrowser", destfile))
+    return Test_dlhn
 
 
 def main(argv=None):
@@ -516,8 +3379,17 @@ def main(argv=None):
 
     prs.add_option('-u', '--username',
                    dest='username',
-                   action='store',
-                   help='HN username to retrieve comments and submissions of')
+                   action='append',
+                   help='HN username to retrieve comments and submissions of'
+                        ' (may be specified more than once'
+                        ' or comma-separated)')
+    prs.add_option('--per-user',
+                   dest='per_user',
+                   action='store_true',
+                   help='With several users, write an archive per user'
+                        ' (e.g. index-<username>.html, or replace'
+                        ' {username} in --output) instead of one'
+                        ' combined archive')
 
     prs.add_option('-o', '--output',
                    dest='output',
@@ -535,6 +3407,117 @@ def main(argv=None):
                         ' and template'
                         ' *instead of* making remote API requests'))
 
+    prs.add_option('-j', '--jobs',
+                   dest='jobs',
+                   action='store',
+                   type='int',
+                   default=1,
+                   help='Number of items to fetch concurrently (default: 1)')
+
+    prs.add_option('--incremental',
+                   dest='incremental',
+                   action='store_true',
+                   help='Only fetch new submissions and items newer than'
+                        ' 14d and merge them into the existing JSON')
+
+    prs.add_option('--resume',
+                   dest='resume',
+                   action='store_true',
+                   help='Resume an interrupted crawl: items in'
+                        ' <output>.journal are not fetched again')
+
+    prs.add_option('--max-depth',
+                   dest='max_depth',
+                   action='store',
+                   type='int',
+                   help="Only fetch replies this many levels below"
+                        " the user's items (0: only the user's items"
+                        " and their parents)")
+    prs.add_option('--max-kids',
+                   dest='max_kids',
+                   action='store',
+                   type='int',
+                   help='Only fetch the first N replies to each item')
+    prs.add_option('--max-items',
+                   dest='max_items',
+                   action='store',
+                   type='int',
+                   help='Stop fetching replies after N items')
+    prs.add_option('--max-seconds',
+                   dest='max_seconds',
+                   action='store',
+                   type='float',
+                   help='Stop fetching replies after N seconds')
+
+    prs.add_option('--rate',
+                   dest='rate',
+                   action='store',
+                   type='float',
+                   default=2.0,
+                   help='Maximum non-cached requests per second;'
+                        ' 0 to disable throttling (default: 2.0)')
+    prs.add_option('--burst',
+                   dest='burst',
+                   action='store',
+                   type='int',
+                   default=8,
+                   help='Number of requests to allow before throttling'
+                        ' (default: 8)')
+
+    prs.add_option('--template',
+                   dest='template',
+                   action='store',
+                   help='Path to a Jinja2 template to use instead of'
+                        ' the built-in template')
+
+    prs.add_option('--shard-size',
+                   dest='shard_size',
+                   action='store',
+                   type='int',
+                   default=None,
+                   help='Write pages of this many root items each'
+                        ' (e.g. index-0001.html) and a table of contents'
+                        ' to --output; only changed pages are rewritten')
+
+    prs.add_option('--lazy',
+                   dest='lazy',
+                   action='store_true',
+                   help="Write collapsed replies which don't contain"
+                        " the user's items to <output>.chunks/ and load"
+                        " them when they're expanded instead of"
+                        " including them in the page")
+
+    prs.add_option('--store',
+                   dest='store_type',
+                   action='store',
+                   type='choice',
+                   choices=['json', 'sqlite'],
+                   default='json',
+                   help="Where to store items: 'json' (<output>.json)"
+                        " or 'sqlite' (<output>.sqlite)"
+                        " (default: json)")
+    prs.add_option('--export-json',
+                   dest='export_json',
+                   action='store_true',
+                   help='Also write <output>.json with --store sqlite')
+    prs.add_option('--compress',
+                   dest='json_compression',
+                   action='store',
+                   type='choice',
+                   choices=['gz', 'zst'],
+                   help="Write <output>.json.gz or <output>.json.zst"
+                        " instead of <output>.json"
+                        " (zst requires zstandard)")
+    prs.add_option('--json-backend',
+                   dest='json_backend',
+                   action='store',
+                   type='choice',
+                   choices=['auto', 'orjson', 'json'],
+                   default='auto',
+                   help="JSON library to read and write the archive with:"
+                        " 'auto' uses orjson if it's installed"
+                        " (default: auto)")
+
     prs.add_option('--expire-after',
                    dest='expire_after',
                    action='store',
@@ -547,6 +3530,27 @@ def main(argv=None):
                    help="Expire posts newer than e.g. 14d."
                    " HN does not allow edits after 14d.")
 
+    prs.add_option('--watch',
+                   dest='watch',
+                   action='store_true',
+                   help='Keep running: update the archive and then poll'
+                        " the user's profile and the API's updates every"
+                        ' --watch-interval seconds, rewriting the JSON'
+                        ' and HTML only when items changed')
+    prs.add_option('--watch-interval',
+                   dest='watch_interval',
+                   action='store',
+                   type='float',
+                   default=60.0,
+                   help='Seconds between polls with --watch (default: 60)')
+
+    prs.add_option('--metrics',
+                   dest='metrics',
+                   action='store',
+                   help='Path to write timings per phase and counters'
+                        ' (e.g. GETs, cache hits, bytes fetched,'
+                        ' seconds throttled) to as JSON')
+
     prs.add_option('-h', '--help',
                    action='store_true')
     prs.add_option('-v', '--verbose',
@@ -572,8 +3576,11 @@ def main(argv=None):
     log.debug('args: %r', args)
 
     if opts.run_tests:
-        sys.argv = [sys.argv[0]] + args
-        return unittest.main()
+        import unittest
+        suite = unittest.TestLoader().loadTestsFromTestCase(get_test_case())
+        result = unittest.TextTestRunner(
+            verbosity=2 if opts.verbose else 1).run(suite)
+        return 0 if result.wasSuccessful() else 1
 
     if opts.help:
         prs.print_help()
@@ -582,6 +3589,10 @@ def main(argv=None):
     if opts.username is None and opts.inputjson is None:
         prs.print_help()
         prs.error('-u/--username must be specified')
+    if opts.watch and (opts.username is None or opts.inputjson
+                       or opts.per_user or opts.store_type != 'json'):
+        prs.error('--watch requires -u/--username and does not support'
+                  ' -i/--input, --per-user, or --store sqlite')
 
     def parse_timedeltastr(str_, default_days=14):
         if str_ is None:
@@ -598,19 +3609,66 @@ def main(argv=None):
             delta = datetime.timedelta(days=int(str_))
         return delta
 
+    global JSON_BACKEND
+    JSON_BACKEND = opts.json_backend
+
     expire_after = parse_timedeltastr(opts.expire_after)
     expire_newerthan = parse_timedeltastr(opts.expire_newerthan)
     basedir = os.path.dirname(opts.output)
-    build_requests_session(basedir,
-                           expire_after=expire_after,
-                           expire_newerthan=expire_newerthan,
-                           always_set=True)
+    metrics = Metrics()
+    with metrics.phase('expire'):
+        build_requests_session(basedir,
+                               expire_after=expire_after,
+                               expire_newerthan=expire_newerthan,
+                               always_set=True,
+                               rate=opts.rate,
+                               burst=opts.burst)
 
     EX_OK = 0
+    if opts.watch:
+        watcher = Watcher(
+            opts.username,
+            output=opts.output,
+            jobs=opts.jobs,
+            template=opts.template,
+            shard_size=opts.shard_size,
+            json_compression=opts.json_compression,
+            lazy=opts.lazy,
+            incremental=opts.incremental,
+            resume=opts.resume,
+            max_depth=opts.max_depth,
+            max_kids=opts.max_kids,
+            max_items=opts.max_items,
+            max_seconds=opts.max_seconds)
+        try:
+            watcher.run(interval=opts.watch_interval)
+        except KeyboardInterrupt:
+            log.info("Stopped watching %r", opts.output)
+        return EX_OK
+
     output = dlhn(
         opts.username,
         output=opts.output,
-        inputjson=opts.inputjson)
+        inputjson=opts.inputjson,
+        jobs=opts.jobs,
+        incremental=opts.incremental,
+        return_html=False,
+        template=opts.template,
+        shard_size=opts.shard_size,
+        store_type=opts.store_type,
+        export_json=opts.export_json,
+        per_user=opts.per_user,
+        metrics=metrics,
+        json_compression=opts.json_compression,
+        lazy=opts.lazy,
+        resume=opts.resume,
+        max_depth=opts.max_depth,
+        max_kids=opts.max_kids,
+        max_items=opts.max_items,
+        max_seconds=opts.max_seconds)
+    if opts.metrics:
+        log.info("Writing metrics to %r" % opts.metrics)
+        metrics.write(opts.metrics)
     return EX_OK
 
 
@@ -55,6 +55,10 @@ setup(
         ' and submissions from the Hacker News API'
         ' and generate a static HTML archive with a Jinja2 template'),
     install_requires=requirements,
+    extras_require={
+        'orjson': ['orjson'],
+        'zstd': ['zstandard'],
+    },
     license="BSD license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -3,11 +3,18 @@
 
 """Tests for `dlhn` package."""
 
+import datetime
 import difflib
+import io
+import json
 import os
+import subprocess
+import sys
 
 import bs4
 import pytest
+import requests
+import urllib3
 
 from dlhn import dlhn
 from dlhn.dlhn import main
@@ -61,3 +68,769 @@ def test_main_pull(tmpdir, username=TESTUSERNAME):
 
     diff = difflib.unified_diff(file1, file2)
     assert "" == "\n".join(list(diff))
+
+
+class FakeResponse(object):
+
+    def __init__(self, json_, status_code=200):
+        self._json = json_
+        self.status_code = status_code
+        self.from_cache = False
+
+    def json(self):
+        return self._json
+
+
+class FakeSession(object):
+    """A stand-in for dlhn.REQUESTS which serves items from a dict"""
+
+    def __init__(self, users, items):
+        self.users = users
+        self.items = items
+        self.updates = dict(items=[], profiles=[])
+        self.status_codes = {}
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        path = url.split('/v0/', 1)[1].split('?', 1)[0]
+        if path == 'updates.json':
+            return FakeResponse(self.updates)
+        kind, key = path[:-len('.json')].split('/')
+        if kind == 'user':
+            return FakeResponse(self.users.get(key))
+        return FakeResponse(self.items.get(int(key)),
+                            status_code=self.status_codes.get(path, 200))
+
+
+def make_fake_hn(username=TESTUSERNAME):
+    """
+    Build a small HN tree: two stories by others with replies,
+    the user's comments under them, and one story by the user
+    """
+    t = 1500000000
+    items = {
+        1: dict(id=1, type='story', by='pg', time=t, title='One',
+                score=10, kids=[2, 3]),
+        2: dict(id=2, type='comment', by=username, time=t + 1, parent=1,
+                text='first &amp; <b>bold</b> http://example.com',
+                kids=[4]),
+        3: dict(id=3, type='comment', by='other', time=t + 2, parent=1,
+                text='other', kids=[5]),
+        4: dict(id=4, type='comment', by='other', time=t + 3, parent=2,
+                text='reply', kids=[6]),
+        5: dict(id=5, type='comment', by=username, time=t + 4, parent=3,
+                text='second'),
+        6: dict(id=6, type='comment', by=username, time=t + 5, parent=4,
+                text='third'),
+        7: dict(id=7, type='story', by=username, time=t + 6, title='Mine',
+                url='https://example.com/', score=3, kids=[8]),
+        8: dict(id=8, type='comment', by='other', time=t + 7, parent=7,
+                deleted=True),
+    }
+    users = {username: dict(id=username, submitted=[7, 6, 5, 2])}
+    return FakeSession(users, items)
+
+
+@pytest.fixture
+def fake_hn(monkeypatch):
+    session = make_fake_hn()
+    monkeypatch.setattr(dlhn, 'REQUESTS', session)
+    monkeypatch.setattr(dlhn, 'CLEAN_MEMO', None)
+    monkeypatch.setattr(dlhn, 'FRAGMENT_MEMO', None)
+    return session
+
+
+def test_get_items_jobs(fake_hn, username=TESTUSERNAME):
+    items, roots = dlhn.get_items(username)
+    nurls = len(fake_hn.urls)
+    assert list(items) == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert roots == [7, 1]
+    assert 'rel="nofollow noopener"' in items[2]['text']
+
+    fake_hn.items = make_fake_hn().items
+    items_jobs, roots_jobs = dlhn.get_items(username, jobs=4)
+    assert len(fake_hn.urls) == nurls * 2
+    assert roots_jobs == roots
+    assert (json.dumps(items_jobs, default=dlhn.json_default)
+            == json.dumps(items, default=dlhn.json_default))
+
+    # fetched items prefetch their kids within the scope limits
+    fake_hn.items = make_fake_hn().items
+    fake_hn.urls = []
+    items_jobs, roots_jobs = dlhn.get_items(username, jobs=4, max_depth=0)
+    assert not any(url.endswith('/item/8.json') for url in fake_hn.urls)
+    assert list(items_jobs) == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_get_items_jobs_requests(fake_hn, username=TESTUSERNAME):
+    # the user's comment 2 is only visited as the parent of their newer
+    # comment 6, so its other replies aren't crawled
+    fake_hn.items[2]['kids'].append(9)
+    fake_hn.items[9] = dict(id=9, type='comment', by='other',
+                            time=1500000009, parent=2, text='sibling')
+    items, roots = dlhn.get_items(username)
+    urls = sorted(url.split('?')[0] for url in fake_hn.urls)
+    assert 9 not in items
+    for n in range(3):
+        fake_hn.items.update(make_fake_hn().items)
+        fake_hn.items[2]['kids'].append(9)
+        fake_hn.urls = []
+        items_jobs, roots_jobs = dlhn.get_items(username, jobs=4)
+        assert sorted(url.split('?')[0] for url in fake_hn.urls) == urls
+        assert list(items_jobs) == list(items)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_ratelimiter():
+    clock = FakeClock()
+    limiter = dlhn.RateLimiter(rate=2.0, burst=3,
+                               clock=clock, sleep=clock.sleep)
+    waits = [limiter.acquire() for n in range(5)]
+    assert waits == [0.0, 0.0, 0.0, 0.5, 0.5]
+    assert limiter.throttled == 1.0
+
+    clock.now += 10
+    limiter.backoff(retry_after=4)
+    assert limiter.rate == 1.0
+    assert limiter.acquire() == 4.0
+    limiter.recover()
+    assert limiter.rate == 1.2
+
+
+def test_dlhn_incremental(fake_hn, tmpdir, monkeypatch,
+                          username=TESTUSERNAME):
+    destfile = str(tmpdir / "dlhn-incremental.html")
+    dlhn.dlhn(username, output=destfile)
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert data['submitted'] == {username: [7, 6, 5, 2]}
+
+    now = int(dlhn.time.time())
+
+    def add_reply(fake_hn):
+        fake_hn.items[4]['kids'].append(9)
+        fake_hn.items[9] = dict(id=9, type='comment', by=username,
+                                time=now, parent=4, text='new')
+        fake_hn.users[username]['submitted'].insert(0, 9)
+    add_reply(fake_hn)
+    fake_hn.urls = []
+    dlhn.dlhn(username, output=destfile, incremental=True)
+    assert len(fake_hn.urls) == 2
+    assert fake_hn.urls[1].endswith('/item/9.json')
+
+    with open(destfile + '.json') as _file:
+        data_incremental = json.load(_file)
+    assert list(data_incremental['items']) == [
+        str(n) for n in range(1, 10)]
+    assert data['roots'] == [7, 1]
+    assert data_incremental['roots'] == [1, 7]
+    assert data_incremental['items']['4']['kids'] == [6, 9]
+    assert data_incremental['submitted'][username][0] == 9
+
+    # the same as a full crawl of the same data
+    # (from a new FakeSession, since the crawl cleans the items in place)
+    fake_hn = make_fake_hn()
+    add_reply(fake_hn)
+    monkeypatch.setattr(dlhn, 'REQUESTS', fake_hn)
+    fullfile = str(tmpdir / "dlhn-full.html")
+    dlhn.dlhn(username, output=fullfile)
+    with open(fullfile + '.json') as _file:
+        data_full = json.load(_file)
+    for key in ('items', 'roots', 'submitted'):
+        assert data_incremental[key] == data_full[key]
+
+
+def test_dlhn_resume(fake_hn, tmpdir, monkeypatch, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    get = fake_hn.get
+
+    def interrupted_get(url, **kwargs):
+        if len(fake_hn.urls) == 5:
+            raise KeyboardInterrupt()
+        return get(url, **kwargs)
+    monkeypatch.setattr(fake_hn, 'get', interrupted_get)
+    with pytest.raises(KeyboardInterrupt):
+        dlhn.dlhn(username, output=destfile)
+    assert not os.path.exists(destfile + '.json')
+    with open(destfile + '.journal', 'ab') as _file:
+        _file.write(b'[9, {"partial')
+    assert list(dlhn.CrawlJournal(destfile + '.journal').load()) == [7, 8, 6, 4]
+
+    monkeypatch.setattr(fake_hn, 'get', get)
+    fake_hn.urls = []
+    html = dlhn.dlhn(username, output=destfile, resume=True)
+    assert [url.rsplit('/', 1)[1] for url in fake_hn.urls[1:]] == [
+        '2.json', '1.json', '5.json', '3.json']
+    assert not os.path.exists(destfile + '.journal')
+
+    session = make_fake_hn()
+    monkeypatch.setattr(dlhn, 'REQUESTS', session)
+    assert dlhn.dlhn(username, output=str(tmpdir / "full.html")) == html
+    assert len(session.urls) == 9
+
+
+def test_dlhn_max_depth(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    html = dlhn.dlhn(username, output=destfile, max_depth=0)
+    assert not any(url.endswith('/item/8.json') for url in fake_hn.urls)
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert list(data['items']) == [str(n) for n in range(1, 8)]
+    assert data['items']['7']['truncated'] == 1
+    assert 'truncated' not in data['items']['2']
+    bs = bs4.BeautifulSoup(html, features='html.parser')
+    assert [elem.text.strip() for elem in bs.find_all(class_='truncated')] \
+        == ['1 more reply on HN']
+
+    fake_hn.items = make_fake_hn().items
+    dlhn.dlhn(username, output=destfile)
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert 'truncated' not in data['items']['7']
+
+
+def test_watcher(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    watcher = dlhn.Watcher(username, output=destfile)
+    watcher.run(interval=0, iterations=1, sleep=lambda seconds: None)
+    assert list(watcher.data['items']) == [str(n) for n in range(1, 9)]
+    os.utime(destfile, (0, 0))
+    fake_hn.urls = []
+    assert watcher.poll() == []
+    assert len(fake_hn.urls) == 2
+    assert os.path.getmtime(destfile) == 0
+
+    now = int(dlhn.time.time())
+    fake_hn.items[6]['kids'] = [9]
+    fake_hn.items[9] = dict(id=9, type='comment', by='other', time=now,
+                            parent=6, text='reply to third')
+    fake_hn.items[10] = dict(id=10, type='comment', by=username, time=now,
+                             parent=8, text='new')
+    fake_hn.users[username]['submitted'].insert(0, 10)
+    fake_hn.updates = dict(items=[10, 9, 6, 100], profiles=[username])
+    fake_hn.urls = []
+    assert sorted(watcher.poll()) == [6, 9, 10]
+    assert sorted(url.rsplit('/', 1)[1].split('?')[0]
+                  for url in fake_hn.urls[2:]) == [
+        '10.json', '6.json', '9.json']
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert data['items']['6']['kids'] == [9]
+    assert data['items']['8']['kids'] == [10]
+    assert data['submitted'][username][0] == 10
+    assert data['roots'] == [7, 1]
+    with open(destfile) as _file:
+        html = _file.read()
+    assert 'id="comment-9"' in html and 'id="comment-10"' in html
+
+
+def test_dlhn_inputjson(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "dlhn-crawl.html")
+    html = dlhn.dlhn(username, output=destfile)
+    destfile2 = str(tmpdir / "dlhn-input.html")
+    html2 = dlhn.dlhn(None, output=destfile2, inputjson=destfile + '.json',
+                      inputjson_upgrade=False)
+    assert html2 == html
+    assert not os.path.exists(destfile2 + '.json')
+
+
+def test_dlhn_return_html(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "dlhn-render.html")
+    html = dlhn.dlhn(username, output=destfile)
+    destfile2 = str(tmpdir / "dlhn-stream.html")
+    output = dlhn.dlhn(None, output=destfile2, inputjson=destfile + '.json',
+                       inputjson_upgrade=False, return_html=False)
+    assert output is None
+    with open(destfile, 'rb') as _file1, open(destfile2, 'rb') as _file2:
+        assert _file1.read() == _file2.read()
+    assert not os.path.exists(destfile2 + '.tmp')
+
+
+def test_dlhn_template(fake_hn, tmpdir, username=TESTUSERNAME):
+    templatefile = tmpdir / "custom.html"
+    templatefile.write("{{ usernames[0] }}: {{ roots|join(',') }}")
+    output = dlhn.dlhn(username, output=str(tmpdir / "dlhn-custom.html"),
+                       template=str(templatefile))
+    assert output == '%s: 7,1' % username
+    assert dlhn.get_template() is dlhn.get_template()
+
+
+def test_dlhn_shard_size(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    output = dlhn.dlhn(username, output=destfile, shard_size=1)
+    assert output is None
+    with open(destfile) as _file:
+        bs = bs4.BeautifulSoup(_file, features='html.parser')
+    hrefs = [a['href'] for a in bs.find('tbody').find_all('a')
+             if not a['href'].startswith('https:')]
+    assert hrefs == ['index-0002.html#story-7', 'index-0001.html#story-1']
+    assert bs.find(id='items') is None
+    with open(str(tmpdir / "index-0001.html")) as _file:
+        bs = bs4.BeautifulSoup(_file, features='html.parser')
+    assert bs.find(id='story-1') is not None
+    assert bs.find(id='story-7') is None
+
+    os.utime(str(tmpdir / "index-0001.html"), (0, 0))
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    rendered = dlhn.render_shards(
+        dlhn.normalize_data(data), destfile, 1)
+    assert rendered == []
+    data['submitted'][username].insert(0, 100)
+    rendered = dlhn.render_shards(
+        dlhn.normalize_data(data), destfile, 1)
+    assert rendered == []
+    data['items']['8']['text'] = 'undeleted'
+    rendered = dlhn.render_shards(
+        dlhn.normalize_data(data), destfile, 1)
+    assert rendered == [str(tmpdir / "index-0002.html")]
+    assert os.path.getmtime(str(tmpdir / "index-0001.html")) == 0
+
+    # a new reply in the oldest thread moves its root to the front
+    os.utime(str(tmpdir / "index-0002.html"), (0, 0))
+    data['items']['1']['kids'].append(9)
+    data['items']['9'] = dict(id=9, type='comment', by='other', parent=1,
+                              time=1500000009, text='new reply')
+    data['roots'] = [1, 7]
+    rendered = dlhn.render_shards(
+        dlhn.normalize_data(data), destfile, 1)
+    assert rendered == [str(tmpdir / "index-0001.html")]
+    assert os.path.getmtime(str(tmpdir / "index-0002.html")) == 0
+
+
+def test_render_fragments(fake_hn, tmpdir, monkeypatch,
+                          username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    _, metrics = dlhn.dlhn(username, output=destfile, return_metrics=True)
+    assert metrics['counters']['fragments_rendered'] == 2
+    with open(destfile + '.json') as _file:
+        data = dlhn.normalize_data(json.load(_file))
+    data['items']['8']['text'] = 'undeleted'
+    metrics = dlhn.Metrics()
+    monkeypatch.setattr(dlhn, 'METRICS', metrics)
+    dlhn.render_html(data, destfile)
+    assert metrics.counters['fragment_hits'] == 1
+    assert metrics.counters['fragments_rendered'] == 1
+    # the changed subtree's fragment replaced the old one
+    dlhn.FRAGMENT_MEMO.flush()
+    assert dlhn.FRAGMENT_MEMO.conn.execute(
+        'SELECT COUNT(*) FROM memo').fetchone()[0] == 2
+
+    monkeypatch.setattr(dlhn, 'FRAGMENT_MEMO', None)
+    uncached = str(tmpdir / "uncached.html")
+    dlhn.render_html(data, uncached)
+    with open(destfile, 'rb') as _file1, open(uncached, 'rb') as _file2:
+        assert _file1.read() == _file2.read()
+
+
+def test_dlhn_lazy(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    html = dlhn.dlhn(username, output=destfile, lazy=True)
+    bs = bs4.BeautifulSoup(html, features='html.parser')
+    lazy = bs.find_all(class_='lazy')
+    assert [elem['id'] for elem in lazy] == ['comment-8']
+    assert lazy[0]['data-chunk'] == 'index.html.chunks/7.js'
+    assert '[deleted]' not in html
+    assert bs.find(id='comment-4') is not None
+    with open(str(tmpdir / "index.html.chunks" / "7.js")) as _file:
+        chunk = _file.read()
+    assert chunk.startswith('dlhnChunk({"comment-8": ')
+    assert chunk.endswith(');\n')
+    chunk = json.loads(chunk[len('dlhnChunk('):-len(');\n')])
+    assert '[deleted]' in chunk['comment-8']
+
+    dlhn.dlhn(username, output=destfile, lazy=True, shard_size=1)
+    assert os.path.exists(str(tmpdir / "index-0002.html.chunks" / "7.js"))
+    with open(str(tmpdir / "index-0001.html.chunks.json")) as _file:
+        assert json.load(_file) == {}
+
+
+def test_upgrade_items_jobs():
+    texts = ['<p>%d &amp; <script>x</script> http://example.com/%d'
+             % (n, n) for n in range(50)]
+    items = dict((str(n), dict(id=n, type='comment', text=text))
+                 for n, text in enumerate(texts))
+    items_jobs = dict((key, dict(item)) for key, item in items.items())
+    dlhn.upgrade_items(items)
+    dlhn.upgrade_items(items_jobs, jobs=2, chunksize=10)
+    assert items_jobs == items
+    assert items['3']['text'] == dlhn.build_cleaner().clean(texts[3])
+
+
+def test_clean_memo(tmpdir, monkeypatch):
+    memo = dlhn.CleanMemo(str(tmpdir / 'clean.sqlite'), maxsize=2)
+    monkeypatch.setattr(dlhn, 'CLEAN_MEMO', memo)
+    cleaned = dlhn.cleanup_html('a &lt;b&gt; http://example.com')
+    assert memo.get('cleanup_html', 'a &lt;b&gt; http://example.com') \
+        == cleaned
+    assert memo.get('clean', 'a &lt;b&gt; http://example.com') is None
+    for n in range(3):
+        dlhn.cleanup_html('text %d' % n)
+    memo.flush()
+    memo = dlhn.CleanMemo(memo.path)
+    assert memo.get('cleanup_html', 'text 2') == 'text 2'
+    assert memo.get('cleanup_html', 'text 0') is None
+
+    monkeypatch.setattr(dlhn, 'ALLOWED_TAGS', ['p'])
+    memo = dlhn.CleanMemo(memo.path)
+    assert memo.get('cleanup_html', 'text 2') is None
+
+
+def test_dlhn_upgrade(fake_hn, tmpdir, monkeypatch, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    dlhn.dlhn(username, output=destfile)
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert data['meta'] == dict(schema=dlhn.SCHEMA_VERSION,
+                                sanitizer=dlhn.get_sanitizer_version())
+
+    def upgrade_items(items, jobs=1):
+        raise AssertionError('upgrade_items should not be called')
+    _upgrade_items = dlhn.upgrade_items
+    monkeypatch.setattr(dlhn, 'upgrade_items', upgrade_items)
+    mtime = os.path.getmtime(destfile + '.json')
+    dlhn.dlhn(None, output=destfile, inputjson=destfile + '.json')
+    assert os.path.getmtime(destfile + '.json') == mtime
+    monkeypatch.setattr(dlhn, 'upgrade_items', _upgrade_items)
+
+    data['meta']['sanitizer'] = 'old'
+    data['items']['3']['text'] = '<script>x</script>'
+    with open(destfile + '.json', 'w') as _file:
+        json.dump(data, _file)
+    dlhn.dlhn(None, output=destfile, inputjson=destfile + '.json')
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert data['items']['3']['text'] == '&lt;script&gt;x&lt;/script&gt;'
+    assert data['meta']['sanitizer'] == dlhn.get_sanitizer_version()
+
+
+def test_dlhn_store_sqlite(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    html = dlhn.dlhn(username, output=destfile)
+    with open(destfile + '.json', 'rb') as _file:
+        json_ = _file.read()
+
+    html_store = dlhn.dlhn(username, output=destfile, store_type='sqlite',
+                           export_json=True)
+    assert html_store == html
+    with open(destfile + '.json', 'rb') as _file:
+        assert _file.read() == json_
+
+    store = dlhn.ItemStore(str(tmpdir / 'index.html.sqlite'))
+    assert len(store) == 8
+    assert store.get('2')['by'] == username
+    assert store[2] == store.get(2)
+    assert store.get(99) is None
+    assert store.get_data()['roots'] == [7, 1]
+
+    os.remove(destfile + '.json')
+    fake_hn.urls = []
+    dlhn.dlhn(username, output=destfile, store_type='sqlite',
+              incremental=True)
+    assert len(fake_hn.urls) == 1
+    assert not os.path.exists(destfile + '.json')
+
+
+def test_dlhn_store_sqlite_incremental(tmpdir, monkeypatch,
+                                      username=TESTUSERNAME):
+    now = int(dlhn.time.time())
+    outputs = {}
+    for store_type in ('json', 'sqlite'):
+        fake_hn = make_fake_hn()
+        for item in fake_hn.items.values():
+            item['time'] += now - 1500000000
+        monkeypatch.setattr(dlhn, 'REQUESTS', fake_hn)
+        monkeypatch.setattr(dlhn, 'CLEAN_MEMO', None)
+        monkeypatch.setattr(dlhn, 'FRAGMENT_MEMO', None)
+        destfile = str(tmpdir / store_type / "index.html")
+        os.makedirs(os.path.dirname(destfile))
+        dlhn.dlhn(username, output=destfile, store_type=store_type)
+
+        # a refetched parent changed and got a new reply
+        fake_hn.items[4]['text'] = 'EDITED reply'
+        fake_hn.items[4]['kids'].append(9)
+        fake_hn.items[9] = dict(id=9, type='comment', by=username,
+                                time=now + 9, parent=4, text='new')
+        fake_hn.users[username]['submitted'].insert(0, 9)
+        dlhn.dlhn(username, output=destfile, store_type=store_type,
+                  incremental=True)
+        if store_type == 'sqlite':
+            item = dlhn.ItemStore(destfile + '.sqlite').get(4)
+        else:
+            with open(destfile + '.json') as _file:
+                item = json.load(_file)['items']['4']
+        outputs[store_type] = (item['text'], list(item['kids']))
+    assert outputs['sqlite'] == outputs['json'] == ('EDITED reply', [6, 9])
+
+
+class FakeAdapter(requests.adapters.HTTPAdapter):
+    """A transport adapter which serves JSON from a FakeSession"""
+
+    def __init__(self, fake_session):
+        super(FakeAdapter, self).__init__()
+        self.fake_session = fake_session
+
+    def send(self, request, **kwargs):
+        fake_response = self.fake_session.get(request.url)
+        body = json.dumps(fake_response.json()).encode('utf8')
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(body),
+            headers={'Content-Type': 'application/json'},
+            status=fake_response.status_code,
+            preload_content=False,
+            request_url=request.url)
+        return self.build_response(request, raw)
+
+
+def build_fake_requests_session(basedir, fake_session, **kwargs):
+    kwargs.setdefault('rate', 0)
+    dlhn.build_requests_session(basedir, always_set=True, **kwargs)
+    dlhn.REQUESTS.mount('https://', dlhn.RateLimitAdapter(
+        dlhn.REQUESTS.ratelimiter, FakeAdapter(fake_session)))
+    return dlhn.REQUESTS
+
+
+def test_ratelimit_adapter(tmpdir, monkeypatch):
+    monkeypatch.setattr(dlhn, 'REQUESTS', None)
+    fake_session = make_fake_hn()
+    fake_session.status_codes['item/3.json'] = 429
+    session = build_fake_requests_session(
+        str(tmpdir), fake_session, rate=1000.0, burst=100)
+    limiter = session.ratelimiter
+    acquired = []
+    acquire = limiter.acquire
+    monkeypatch.setattr(limiter, 'acquire',
+                        lambda: acquired.append(1) or acquire())
+    url = dlhn.HN_API_URL + '/item/%d.json'
+    for n in range(2):
+        assert session.get(url % 1).json()['id'] == 1
+        assert session.get(url % 2).json()['id'] == 2
+    # cached responses don't take tokens
+    assert len(fake_session.urls) == 2
+    assert len(acquired) == 2
+
+    assert session.get(url % 3).status_code == 429
+    assert len(acquired) == 3
+    assert limiter.rate == 500.0
+    session.get(url % 4)
+    assert len(acquired) == 4
+    assert limiter.rate == 600.0
+
+
+def test_frozen_items(tmpdir, monkeypatch):
+    monkeypatch.setattr(dlhn, 'REQUESTS', None)
+    fake_session = make_fake_hn()
+    fake_session.items[10] = dict(id=10, type='comment', by='other',
+                                  time=int(dlhn.time.time()), parent=1,
+                                  text='new')
+    build_fake_requests_session(str(tmpdir), fake_session,
+                                expire_after=datetime.timedelta(days=1))
+    daysago_14 = dlhn.time.time() - 14 * 24 * 60 * 60
+    for n in range(2):
+        assert dlhn.get_item_json(1, cache_before=daysago_14)['id'] == 1
+        assert dlhn.get_item_json(10, cache_before=daysago_14)['id'] == 10
+    # item 1 is frozen; item 10 is revalidated
+    assert len(fake_session.urls) == 3
+    assert len(dlhn.REQUESTS.frozen.keys) == 1
+    key = list(dlhn.REQUESTS.frozen.keys)[0]
+    assert dlhn.REQUESTS.cache.responses[key].expires is None
+
+    build_fake_requests_session(str(tmpdir), fake_session,
+                                expire_newerthan=datetime.timedelta(days=1))
+    assert list(dlhn.REQUESTS.cache.responses.keys()) == [key]
+
+
+def test_created_index(tmpdir):
+    path = str(tmpdir / 'dlhn.sqlite')
+    index = dlhn.CreatedIndex(path)
+    index.conn.execute(
+        'CREATE TABLE responses (key TEXT PRIMARY KEY, value BLOB)')
+    now = datetime.datetime.utcnow()
+    for n, days in enumerate((30, 20, 1, 0)):
+        key = 'key%d' % n
+        index.conn.execute('INSERT INTO responses VALUES (?, ?)', (key, ''))
+        index.add(key, dlhn._timestamp(now - datetime.timedelta(days=days)))
+    index.conn.execute("INSERT INTO dlhn_frozen VALUES ('key0', 1, 0)")
+    assert index.conn.execute(
+        'SELECT COUNT(*) FROM dlhn_created').fetchone()[0] == 0
+    deleted = index.remove(
+        created_after=now - datetime.timedelta(days=14),
+        created_before=now - datetime.timedelta(days=25))
+    assert deleted == 2
+    keys = [row[0] for row in index.conn.execute('SELECT key FROM responses')]
+    assert keys == ['key0', 'key1']
+
+
+def test_created_index_unflushed(tmpdir, monkeypatch):
+    monkeypatch.setattr(dlhn, 'REQUESTS', None)
+    fake_session = make_fake_hn()
+    session = build_fake_requests_session(str(tmpdir), fake_session)
+    url = dlhn.HN_API_URL + '/item/%d.json'
+    session.get(url % 1)
+    session.created.flush()
+    session.get(url % 2)
+    # as if the crawl had been killed before the index was flushed
+    session.created.pending.clear()
+    session = build_fake_requests_session(
+        str(tmpdir), fake_session,
+        expire_newerthan=datetime.timedelta(days=1))
+    assert len(session.cache.responses) == 0
+    assert session.created.conn.execute(
+        'SELECT COUNT(*) FROM dlhn_created').fetchone()[0] == 0
+
+
+def test_dlhn_usernames(fake_hn, tmpdir, username=TESTUSERNAME):
+    fake_hn.users['other'] = dict(id='other', submitted=[8, 4, 3])
+    destfile = str(tmpdir / "index.html")
+    dlhn.dlhn([username, 'other'], output=destfile)
+    assert len(fake_hn.urls) == len(set(fake_hn.urls)) == 2 + 8
+    with open(destfile + '.json') as _file:
+        data = json.load(_file)
+    assert data['usernames'] == [username, 'other']
+    assert list(data['submitted']) == [username, 'other']
+    assert data['roots'] == [7, 1]
+
+    fake_hn.items = make_fake_hn().items
+    fake_hn.urls = []
+    outputs = dlhn.dlhn('%s,other' % username,
+                        output=str(tmpdir / "{username}" / "index.html"),
+                        per_user=True)
+    assert len(outputs) == 2
+    assert len(fake_hn.urls) == len(set(fake_hn.urls)) == 2 + 8
+    with open(str(tmpdir / "other" / "index.html.json")) as _file:
+        data = json.load(_file)
+    assert data['usernames'] == ['other']
+    assert list(data['items']) == ['1', '2', '3', '4', '5', '6', '7', '8']
+
+
+def test_dlhn_metrics(fake_hn, tmpdir, username=TESTUSERNAME):
+    destfile = str(tmpdir / "index.html")
+    html, metrics = dlhn.dlhn(username, output=destfile, return_metrics=True)
+    assert html
+    assert metrics['counters']['http_get'] == 1 + 8
+    assert metrics['counters']['sanitized'] == 5
+    assert metrics['counters']['items_peak'] == 8
+    for phase in ('crawl', 'sanitize', 'json_write', 'render', 'total'):
+        assert metrics['phases'][phase] >= 0
+
+    fake_hn.items = make_fake_hn().items
+    html2, metrics = dlhn.dlhn(username, output=destfile, return_metrics=True)
+    assert html2 == html
+    assert metrics['counters']['http_get'] == 1
+    assert metrics['counters']['item_cache_hits'] == 8
+    assert 'json_read' in metrics['phases']
+
+    metricsfile = str(tmpdir / "metrics.json")
+    assert main(["-i", destfile + '.json', "-o", str(tmpdir / "out.html"),
+                 "--metrics", metricsfile]) == 0
+    with open(metricsfile) as _file:
+        metrics = json.load(_file)
+    assert metrics['version'] == dlhn.__version__
+    assert 'render' in metrics['phases']
+
+
+# microseconds; importing dlhn with bleach, jinja2, and requests_cache
+# took ~400ms
+IMPORT_TIME_BUDGET = 150000
+
+
+def test_import_time():
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import dlhn.dlhn'],
+        stderr=subprocess.STDOUT,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    cumulative = {}
+    for line in output.decode('utf8').splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _self, _cumulative, name = line[len('import time:'):].split('|')
+            if _cumulative.strip().isdigit():
+                cumulative[name.strip()] = int(_cumulative)
+    heavy = [name for name in cumulative if name.split('.')[0] in
+             ('bleach', 'bs4', 'jinja2', 'requests_cache', 'unittest')]
+    assert heavy == []
+    assert cumulative['dlhn.dlhn'] < IMPORT_TIME_BUDGET
+
+
+def test_item():
+    obj = dict(id=2, type='comment', by='pg', time=1, parent=1,
+               kids=[4, 3], extra=True)
+    item = dlhn.Item(obj)
+    assert item == obj
+    assert list(item) == list(obj)
+    assert json.dumps(item, default=dlhn.json_default) == json.dumps(obj)
+    assert item.kids[0] == 4 and item['extra'] is True
+    assert item.get('title') is None and 'title' not in item
+    item['text'] = 'x'
+    item.setdefault('kids', []).append(5)
+    del item['extra']
+    assert list(item) == ['id', 'type', 'by', 'time', 'parent', 'kids',
+                          'text']
+    assert item['kids'].tolist() == [4, 3, 5]
+
+    data = json.loads(json.dumps(dict(items={'2': obj}, roots=[1])),
+                      object_pairs_hook=dlhn.json_object_pairs_hook)
+    assert isinstance(data['items']['2'], dlhn.Item)
+    assert not isinstance(data, dlhn.Item)
+    html = dlhn.get_template().render(
+        str=str, usernames=['pg'], items=data['items'], roots=[2])
+    assert 'id="comment-2"' in html
+
+
+@pytest.mark.parametrize('compression', ['gz', 'zst'])
+def test_dlhn_json_compression(fake_hn, tmpdir, compression,
+                               username=TESTUSERNAME):
+    if compression == 'zst':
+        pytest.importorskip('zstandard')
+    destfile = str(tmpdir / "index.html")
+    html = dlhn.dlhn(username, output=destfile)
+    html2, metrics = dlhn.dlhn(username, output=destfile,
+                               json_compression=compression,
+                               return_metrics=True)
+    assert html2 == html
+    assert metrics['counters']['item_cache_hits'] == 8
+    jsonpath = '%s.json.%s' % (destfile, compression)
+    assert (dlhn.read_json(jsonpath, backend='json')
+            == dlhn.read_json(destfile + '.json', backend='json'))
+
+    destfile2 = str(tmpdir / "input.html")
+    assert main(["-i", jsonpath, "-o", destfile2]) == 0
+    with open(destfile, 'rb') as _file1, open(destfile2, 'rb') as _file2:
+        assert _file1.read() == _file2.read()
+
+
+def test_json_backends(tmpdir):
+    pytest.importorskip('orjson')
+    data = dict(usernames=['pg'], roots=[1], items={
+        '1': dict(id=1, type='story', kids=[2],
+                  title=u'caf\xe9 \u2028 \U0001f600 \x7f')})
+    contents = []
+    for backend in ('json', 'orjson'):
+        path = str(tmpdir / ('%s.json' % backend))
+        dlhn.write_json(data, path, backend=backend)
+        for _backend in ('json', 'orjson'):
+            assert dlhn.read_json(path, backend=_backend) == data
+        with open(path, 'rb') as _file:
+            contents.append(_file.read())
+    # the archive's bytes don't depend on which backend is installed
+    assert contents[0] == contents[1]
+    data['items']['2'] = dict(id=2, type='comment', parent=1, text='x')
+    for batchsize in (1, 2):
+        path = str(tmpdir / 'batch.json')
+        dlhn.write_json(data, path, backend='orjson', batchsize=batchsize)
+        with open(path, 'rb') as _file:
+            assert _file.read() == dlhn.dumps_json(
+                data, backend='json').encode('ascii')
+    assert (dlhn.dumps_json(data, backend='orjson')
+            == dlhn.dumps_json(data, backend='json'))